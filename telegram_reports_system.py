@@ -13,29 +13,819 @@
 2. Ручной запуск для тестирования (в конце файла)
 
 ЗАВИСИМОСТИ:
-pip install apache-airflow pandas numpy matplotlib seaborn pandahouse python-telegram-bot requests
+pip install apache-airflow pandas numpy pyarrow matplotlib seaborn pandahouse python-telegram-bot requests
 """
 
 import telegram
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use('Agg')  # без дисплея, до импорта seaborn/pyplot
+from matplotlib import font_manager
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
+import glob
+import hashlib
 import io
+import json
 import logging
+import math
 import pandas as pd
+import pyarrow as pa
 import os
-
+import pickle
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from io import StringIO
+from urllib.parse import urlencode
 import requests
 import pandahouse as ph
 
 from airflow.decorators import dag, task
+from airflow.exceptions import AirflowFailException
 from airflow.operators.python import get_current_context
 
 
-def generate_basic_information(chat_id):
-    bot = telegram.Bot(token=BOT_TOKEN)
+# ============================================================================
+# ОЧЕРЕДЬ ДОСТАВКИ (OUTBOX)
+# ============================================================================
+
+# Каждый посчитанный результат (датафрейм, текст, картинка) и каждая отправка
+# записываются в локальную SQLite по ключу (запуск, чат, часть отчета).
+# Запуск - run_id Airflow: он одинаковый у повторов одной задачи и разный у
+# разных запусков, даже с одним ds (ручной запуск и плановый на следующий день).
+# При повторной попытке уже посчитанное берется из базы, а уже отправленное
+# в чат повторно не отправляется.
+
+# Ручной запуск без run_id: один ключ на процесс, продолжить упавший ручной
+# запуск можно флагом --run-id
+OUTBOX_MANUAL_RUN_ID = f"manual__{datetime.now().isoformat(timespec='seconds')}"
+
+
+def open_outbox():
+    outbox = sqlite3.connect(OUTBOX_PATH, timeout=30)
+
+    # Таблицы старого формата с ключом по дате запуска пересоздаем:
+    # в outbox только кэш повторов, его можно потерять
+    columns = [row[1] for row in outbox.execute('PRAGMA table_info(artifacts)')]
+    if columns and 'run_id' not in columns:
+        outbox.execute('DROP TABLE artifacts')
+        outbox.execute('DROP TABLE IF EXISTS deliveries')
+
+    outbox.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+                          run_id TEXT NOT NULL,
+                          chat_id TEXT NOT NULL,
+                          part TEXT NOT NULL,
+                          payload BLOB NOT NULL,
+                          created_at TEXT NOT NULL,
+                          PRIMARY KEY (run_id, chat_id, part))''')
+    outbox.execute('''CREATE TABLE IF NOT EXISTS deliveries (
+                          run_id TEXT NOT NULL,
+                          chat_id TEXT NOT NULL,
+                          part TEXT NOT NULL,
+                          delivered_at TEXT NOT NULL,
+                          PRIMARY KEY (run_id, chat_id, part))''')
+
+    # Удаляем записи старше OUTBOX_KEEP_DAYS дней (по времени записи, чтобы
+    # не терять бэкфиллы за старые даты)
+    cutoff = (datetime.now() - timedelta(days=OUTBOX_KEEP_DAYS)).isoformat()
+    outbox.execute('DELETE FROM artifacts WHERE created_at < ?', (cutoff,))
+    outbox.execute('DELETE FROM deliveries WHERE delivered_at < ?', (cutoff,))
+    outbox.commit()
+    return outbox
+
+
+def outbox_run_id(run_id=None):
+    # В Airflow передается run_id запуска, при ручном запуске - ключ процесса
+    if run_id is None:
+        return OUTBOX_MANUAL_RUN_ID
+    return str(run_id)
+
+
+def outbox_run_date(run_date=None):
+    # Дата запуска для хранилища артефактов и учета стоимости запросов:
+    # в Airflow передается ds запуска, при ручном запуске берем сегодняшнюю дату
+    if run_date is None:
+        return datetime.now().strftime('%Y-%m-%d')
+    return str(run_date)
+
+
+def outbox_artifact(run_date, run_id, chat_id, part, build):
+    key = (outbox_run_id(run_id), str(chat_id), part)
+
+    outbox = open_outbox()
+    try:
+        row = outbox.execute('''SELECT payload FROM artifacts
+                                WHERE run_id = ? AND chat_id = ? AND part = ?''', key).fetchone()
+    finally:
+        outbox.close()
+
+    if row is not None:
+        logging.info('outbox: берем сохраненный результат %s', key)
+        value = pickle.loads(row[0])
+        built = False
+    else:
+        # Повторная отправка (ARTIFACTS_REUSE) берет результат за эту дату из
+        # хранилища артефактов, тогда запрос не повторяем
+        value = load_exported_artifact(run_date, part) if ARTIFACTS_REUSE else None
+        built = value is None
+        if built:
+            value = build()
+
+        outbox = open_outbox()
+        try:
+            outbox.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                           key + (pickle.dumps(value), datetime.now().isoformat()))
+            outbox.commit()
+        finally:
+            outbox.close()
+
+    # Заново посчитанное значение перезаписывает файл за эту дату, чтобы в
+    # хранилище лежало то, что отправлено последним
+    export_artifact(run_date, run_id, part, value, overwrite=built)
+    return value
+
+
+def outbox_delivered(run_id, chat_id, part):
+    key = (outbox_run_id(run_id), str(chat_id), part)
+
+    outbox = open_outbox()
+    try:
+        row = outbox.execute('''SELECT 1 FROM deliveries
+                                WHERE run_id = ? AND chat_id = ? AND part = ?''', key).fetchone()
+    finally:
+        outbox.close()
+
+    if row is not None:
+        logging.info('outbox: уже отправлено %s', key)
+    return row is not None
+
+
+def outbox_mark_delivered(run_id, chat_id, part):
+    key = (outbox_run_id(run_id), str(chat_id), part)
+
+    outbox = open_outbox()
+    try:
+        outbox.execute('INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?)',
+                       key + (datetime.now().isoformat(),))
+        outbox.commit()
+    finally:
+        outbox.close()
+
+
+def outbox_send_message(bot, chat_id, run_id, part, text):
+    if outbox_delivered(run_id, chat_id, part):
+        return
+
+    # Отметка ставится после успешной отправки: если задача упадет между
+    # отправкой и отметкой, сообщение уйдет повторно (доставка "хотя бы раз")
+    bot.sendMessage(chat_id=chat_id, text=text)
+    outbox_mark_delivered(run_id, chat_id, part)
+
+
+def outbox_send_photo(bot, chat_id, run_date, run_id, part, build, filename):
+    # build(fmt) рисует график в нужном формате
+    if outbox_delivered(run_id, chat_id, part):
+        return
+
+    # Картинка рендерится один раз, при повторе берется из базы
+    payload = outbox_artifact(run_date, run_id, chat_id, part,
+                              lambda: build().getvalue())
+    plot_object = io.BytesIO(payload)
+    plot_object.name = filename
+
+    bot.sendPhoto(chat_id=chat_id, photo=plot_object)
+    outbox_mark_delivered(run_id, chat_id, part)
+
+    # Векторная копия - только для хранилища, рисуется после доставки картинки
+    if ARTIFACTS_SVG:
+        export_plot_svg(run_date, run_id, part, build)
+
+
+# ============================================================================
+# ХРАНИЛИЩЕ АРТЕФАКТОВ
+# ============================================================================
+
+# Все датафреймы, тексты и графики запуска сохраняются локально:
+# ARTIFACTS_DIR/report=<отчет>/date=<дата запуска>/<имя>.parquet|.png|.svg|.txt
+# и manifest.json с описанием файлов. Для анализа, бэкфиллов и повторных
+# отправок данные читаются отсюда (parquet через memory map), без ClickHouse.
+
+ARTIFACTS_LOCK = threading.Lock()
+
+
+def artifact_partition(report, run_date=None):
+    return os.path.join(ARTIFACTS_DIR, f'report={report}',
+                        f'date={outbox_run_date(run_date)}')
+
+
+def artifact_path(run_date, part, extension):
+    # Часть outbox 'report/dau_source' -> отчет 'report', файл 'dau_source'
+    report, name = part.split('/', 1)
+    return os.path.join(artifact_partition(report, run_date), f'{name}.{extension}')
+
+
+def update_artifact_manifest(path, entry):
+    partition, filename = os.path.split(path)
+    manifest_path = os.path.join(partition, 'manifest.json')
+
+    with ARTIFACTS_LOCK:
+        manifest = read_artifact_manifest(manifest_path)
+        if not manifest:
+            report, run_date = [segment.split('=', 1)[1]
+                                for segment in partition.split(os.sep)[-2:]]
+            manifest = {'report': report, 'date': run_date, 'files': {}}
+
+        with open(path, 'rb') as f:
+            entry['sha256'] = hashlib.sha256(f.read()).hexdigest()
+        entry['bytes'] = os.path.getsize(path)
+        entry['created_at'] = datetime.now().isoformat()
+        manifest['files'][filename] = entry
+
+        # Пишем во временный файл и подменяем, чтобы манифест не был битым
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+
+def read_artifact_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def export_artifact(run_date, run_id, part, value, overwrite=False):
+    if not EXPORT_ARTIFACTS:
+        return
+
+    if isinstance(value, pd.DataFrame):
+        extension, entry = 'parquet', {'kind': 'frame', 'rows': len(value),
+                                       'columns': [str(column) for column in value.columns]}
+    elif isinstance(value, bytes):
+        extension, entry = 'png', {'kind': 'plot'}
+    elif isinstance(value, str):
+        extension, entry = 'txt', {'kind': 'text'}
+    else:
+        return
+
+    path = artifact_path(run_date, part, extension)
+    if os.path.exists(path) and not overwrite:
+        return
+    entry['run_id'] = outbox_run_id(run_id)
+
+    # Ошибка выгрузки не должна мешать отправке отчета
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        if extension == 'parquet':
+            value.to_parquet(tmp_path)
+        elif extension == 'png':
+            with open(tmp_path, 'wb') as f:
+                f.write(value)
+        else:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(value)
+        os.replace(tmp_path, path)
+        update_artifact_manifest(path, entry)
+    except Exception as e:
+        logging.warning('artifacts: не удалось сохранить %s: %s', path, e)
+
+
+def export_plot_svg(run_date, run_id, part, build):
+    # Вызывается после отправки картинки, поэтому всегда перезаписывает файл
+    if not EXPORT_ARTIFACTS:
+        return
+
+    path = artifact_path(run_date, part, 'svg')
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(build('svg').getvalue())
+        os.replace(path + '.tmp', path)
+        update_artifact_manifest(path, {'kind': 'plot', 'run_id': outbox_run_id(run_id)})
+    except Exception as e:
+        logging.warning('artifacts: не удалось сохранить %s: %s', path, e)
+
+
+def load_exported_artifact(run_date, part):
+    for extension in ('parquet', 'png', 'txt'):
+        path = artifact_path(run_date, part, extension)
+        if not os.path.exists(path):
+            continue
+
+        logging.info('artifacts: берем сохраненный файл %s', path)
+        if extension == 'parquet':
+            return pd.read_parquet(path, memory_map=True)
+        if extension == 'png':
+            with open(path, 'rb') as f:
+                return f.read()
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    return None
+
+
+def read_report_manifest(report, run_date):
+    return read_artifact_manifest(
+        os.path.join(artifact_partition(report, run_date), 'manifest.json'))
+
+
+def read_report_frame(report, name, run_date):
+    # run_date - ds запуска (для планового запуска это вчерашний день)
+    return pd.read_parquet(artifact_path(run_date, f'{report}/{name}', 'parquet'),
+                           memory_map=True)
+
+
+def read_report_frames(report, name, date_from=None, date_to=None):
+    # Один датафрейм за несколько запусков, дата запуска - в колонке run_date
+    frames = []
+    for partition in sorted(glob.glob(os.path.join(ARTIFACTS_DIR, f'report={report}', 'date=*'))):
+        run_date = partition.rsplit('date=', 1)[1]
+        if date_from is not None and run_date < str(date_from):
+            continue
+        if date_to is not None and run_date > str(date_to):
+            continue
+
+        path = os.path.join(partition, f'{name}.parquet')
+        if os.path.exists(path):
+            frames.append(pd.read_parquet(path, memory_map=True).assign(run_date=run_date))
+
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+# ============================================================================
+# КОНТРОЛЬ СТОИМОСТИ ЗАПРОСОВ
+# ============================================================================
+
+# Каждый запрос отчета идет через read_clickhouse (без результата - через
+# execute_clickhouse): получает query_id с именем
+# отчета и запроса, а после задачи его read_rows, read_bytes, memory_usage и
+# длительность берутся из system.query_log, сверяются с бюджетом из
+# QUERY_BUDGETS и сохраняются в QUERY_COSTS_PATH для сравнения между запусками.
+# В режиме fail бюджет дополнительно передается в ClickHouse как лимиты
+# (max_rows_to_read и т.д.), и сервер сам прерывает слишком дорогой запрос.
+
+# Запросы текущей задачи: query_id, отчет, имя запроса, время на клиенте
+QUERY_RUN_LOG = []
+QUERY_RUN_LOG_LOCK = threading.Lock()
+
+QUERY_COST_METRICS = ['read_rows', 'read_bytes', 'memory_usage', 'duration_ms']
+
+
+def query_budget(report, name):
+    budget = dict(QUERY_BUDGETS['default'])
+    budget.update(QUERY_BUDGETS.get(f'{report}/{name}', {}))
+    return budget
+
+
+def run_tagged_query(run, query, report, name):
+    # run - ph.read_clickhouse или ph.execute
+    query_id = f'tgreports-{report}-{name}-{uuid.uuid4().hex[:16]}'
+
+    # pandahouse передает в ClickHouse только query, user и password,
+    # поэтому query_id и лимиты добавляем в адрес хоста (requests их сохраняет)
+    params = {'query_id': query_id}
+    if QUERY_BUDGET_MODE == 'fail':
+        budget = query_budget(report, name)
+        params.update({
+            'max_rows_to_read': budget['read_rows'],
+            'max_bytes_to_read': budget['read_bytes'],
+            'max_memory_usage': budget['memory_usage'],
+            # 0 в ClickHouse - без ограничения, поэтому округляем вверх
+            'max_execution_time': max(1, math.ceil(budget['duration_ms'] / 1000)),
+        })
+
+    host = connection['host']
+    separator = '&' if '?' in host else '?'
+    tagged_connection = dict(connection, host=host + separator + urlencode(params))
+
+    # Упавший или прерванный лимитом запрос тоже попадает в учет
+    started = time.perf_counter()
+    try:
+        return run(query=query, connection=tagged_connection)
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with QUERY_RUN_LOG_LOCK:
+            QUERY_RUN_LOG.append({'query_id': query_id, 'report': report,
+                                  'name': name, 'client_ms': elapsed_ms})
+
+
+def read_clickhouse(query, report, name):
+    return run_tagged_query(ph.read_clickhouse, query, report, name)
+
+
+def execute_clickhouse(query, report, name):
+    # Запросы без результата (DDL, мутации, INSERT ... SELECT) учитываются так же
+    return run_tagged_query(ph.execute, query, report, name)
+
+
+def fetch_query_log_stats(query_ids):
+    # Без прав на SYSTEM FLUSH LOGS записи появляются в query_log с задержкой
+    try:
+        ph.execute('SYSTEM FLUSH LOGS', connection=connection)
+    except Exception as e:
+        logging.warning('query costs: SYSTEM FLUSH LOGS недоступен: %s', e)
+
+    ids = ', '.join(f"'{query_id}'" for query_id in query_ids)
+    query_log = f'''SELECT query_id,
+                             read_rows,
+                             read_bytes,
+                             memory_usage,
+                             query_duration_ms AS duration_ms
+                      FROM system.query_log
+                      WHERE type IN ('QueryFinish', 'ExceptionBeforeStart', 'ExceptionWhileProcessing')
+                        AND event_date >= yesterday()
+                        AND query_id IN ({ids})'''
+
+    for attempt in range(QUERY_LOG_ATTEMPTS):
+        df_stats = ph.read_clickhouse(query=query_log, connection=connection)
+        if len(df_stats) >= len(query_ids) or attempt == QUERY_LOG_ATTEMPTS - 1:
+            return df_stats
+        time.sleep(QUERY_LOG_WAIT_SECONDS)
+
+
+def open_query_costs():
+    costs = sqlite3.connect(QUERY_COSTS_PATH, timeout=30)
+    costs.execute('''CREATE TABLE IF NOT EXISTS query_costs (
+                         run_date TEXT NOT NULL,
+                         report TEXT NOT NULL,
+                         name TEXT NOT NULL,
+                         query_id TEXT NOT NULL PRIMARY KEY,
+                         read_rows INTEGER,
+                         read_bytes INTEGER,
+                         memory_usage INTEGER,
+                         duration_ms REAL,
+                         recorded_at TEXT NOT NULL)''')
+    return costs
+
+
+def collect_query_costs(run_date=None, fetch_stats=None, enforce=True):
+    # fetch_stats(query_ids) -> датафрейм query_id + QUERY_COST_METRICS;
+    # для проверки без ClickHouse можно передать заглушку с синтетикой
+    if fetch_stats is None:
+        fetch_stats = fetch_query_log_stats
+
+    with QUERY_RUN_LOG_LOCK:
+        queries = list(QUERY_RUN_LOG)
+        QUERY_RUN_LOG.clear()
+
+    if not queries:
+        return pd.DataFrame(columns=['report', 'name'] + QUERY_COST_METRICS)
+
+    df_costs = pd.DataFrame(queries)
+    try:
+        df_stats = fetch_stats(list(df_costs['query_id']))
+    except Exception as e:
+        logging.warning('query costs: не удалось получить статистику запросов: %s', e)
+        df_stats = pd.DataFrame(columns=['query_id'] + QUERY_COST_METRICS)
+
+    df_costs = df_costs.merge(df_stats, on='query_id', how='left')
+
+    # Если запроса нет в query_log, длительность берем по часам клиента
+    df_costs['duration_ms'] = df_costs['duration_ms'].fillna(df_costs['client_ms'])
+
+    costs = open_query_costs()
+    try:
+        recorded_at = datetime.now().isoformat()
+        for row in df_costs.itertuples():
+            costs.execute('INSERT OR REPLACE INTO query_costs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (outbox_run_date(run_date), row.report, row.name, row.query_id,
+                           None if pd.isna(row.read_rows) else int(row.read_rows),
+                           None if pd.isna(row.read_bytes) else int(row.read_bytes),
+                           None if pd.isna(row.memory_usage) else int(row.memory_usage),
+                           float(row.duration_ms), recorded_at))
+        costs.commit()
+    finally:
+        costs.close()
+
+    # Сверяем с бюджетами
+    violations = []
+    for row in df_costs.itertuples():
+        budget = query_budget(row.report, row.name)
+        for metric in QUERY_COST_METRICS:
+            value = getattr(row, metric)
+            if not pd.isna(value) and value > budget[metric]:
+                violations.append(
+                    f'{row.report}/{row.name}: {metric} = {value:,.0f} > {budget[metric]:,.0f}')
+
+    for violation in violations:
+        logging.warning('query costs: превышен бюджет %s', violation)
+
+    logging.info('query costs:\n%s', format_query_cost_report(run_date))
+
+    # Проверка идет после отправки, а повтор задачи возьмет все из outbox без
+    # запросов и пройдет, поэтому задача падает без повторов
+    if violations and enforce and QUERY_BUDGET_MODE == 'fail':
+        raise AirflowFailException(
+            'Превышен бюджет запросов:\n' + '\n'.join(violations))
+
+    return df_costs
+
+
+@contextmanager
+def query_cost_tracking(run_date=None, fetch_stats=None):
+    # Учет стоимости всех запросов внутри блока. Если блок упал,
+    # статистика все равно сохраняется, но бюджет не проверяется на fail,
+    # чтобы не подменить исходную ошибку
+    with QUERY_RUN_LOG_LOCK:
+        QUERY_RUN_LOG.clear()
+
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        collect_query_costs(run_date, fetch_stats, enforce=not failed)
+
+
+def format_query_cost_report(run_date=None):
+    # Стоимость запросов запуска в сравнении с предыдущим запуском
+    run_date = outbox_run_date(run_date)
+
+    costs = open_query_costs()
+    try:
+        df_costs = pd.read_sql_query('''SELECT run_date, report, name,
+                                                sum(read_rows) AS read_rows,
+                                                sum(read_bytes) AS read_bytes,
+                                                max(memory_usage) AS memory_usage,
+                                                sum(duration_ms) AS duration_ms
+                                         FROM query_costs
+                                         WHERE run_date <= ?
+                                         GROUP BY run_date, report, name''', costs, params=(run_date,))
+    finally:
+        costs.close()
+
+    current = df_costs[df_costs['run_date'] == run_date].set_index(['report', 'name'])
+    previous_dates = df_costs.loc[df_costs['run_date'] < run_date, 'run_date']
+    previous = pd.DataFrame(columns=current.columns)
+    if not previous_dates.empty:
+        previous = df_costs[df_costs['run_date'] == previous_dates.max()
+                            ].set_index(['report', 'name'])
+
+    lines = [f'Стоимость запросов за {run_date}' +
+             (f' (в скобках - изменение к {previous_dates.max()})' if not previous_dates.empty else '')]
+    for (report, name), row in current.iterrows():
+        parts = []
+        for metric in QUERY_COST_METRICS:
+            value = row[metric]
+            if pd.isna(value):
+                parts.append(f'{metric}=?')
+                continue
+            part = f'{metric}={value:,.0f}'
+            if (report, name) in previous.index:
+                before = previous.loc[(report, name), metric]
+                if not pd.isna(before) and before > 0:
+                    part += f' ({(value - before) / before * 100:+.0f}%)'
+            parts.append(part)
+        lines.append(f'- {report}/{name}: ' + ', '.join(parts))
+
+    return '\n'.join(lines)
+
+
+# ============================================================================
+# АГРЕГАТЫ (ROLLUPS) В CLICKHOUSE
+# ============================================================================
+
+# Графики и блоки ленты/мессенджера считаются по toDate(time), source. Чтобы не
+# сканировать сырые таблицы каждый запуск, проект сам ведет агрегаты:
+# - report_daily_source - дневная сводка по источнику и платформе
+#   (уникальные пользователи, лайки, просмотры, сообщения, медиана сообщений)
+# - report_weekly_user_activity - активные пользователи ленты по неделям
+# - report_rollup_log - какие дни уже посчитаны
+# Если в окне отчета посчитан не каждый день, отчеты читают сырые таблицы.
+
+# Миграции применяются по порядку, примененные версии хранятся в
+# report_rollup_migrations
+ROLLUP_MIGRATIONS = [
+    (1, '''CREATE TABLE IF NOT EXISTS {db}.report_daily_source (
+               date Date,
+               source LowCardinality(String),
+               platform LowCardinality(String),
+               users AggregateFunction(uniqExact, UInt64),
+               views SimpleAggregateFunction(sum, UInt64),
+               likes SimpleAggregateFunction(sum, UInt64),
+               messages SimpleAggregateFunction(sum, UInt64),
+               messages_per_user AggregateFunction(quantile(0.5), UInt64)
+           )
+           ENGINE = AggregatingMergeTree
+           PARTITION BY toYYYYMM(date)
+           ORDER BY (date, source, platform)'''),
+    (2, '''CREATE TABLE IF NOT EXISTS {db}.report_weekly_user_activity (
+               week Date,
+               user_id UInt64
+           )
+           ENGINE = ReplacingMergeTree
+           PARTITION BY toYYYYMM(week)
+           ORDER BY (week, user_id)'''),
+    (3, '''CREATE TABLE IF NOT EXISTS {db}.report_rollup_log (
+               date Date,
+               populated_at DateTime
+           )
+           ENGINE = ReplacingMergeTree(populated_at)
+           ORDER BY date'''),
+]
+
+
+# Первый день сырых данных: графики за всю историю читают агрегаты, только
+# если посчитан каждый день начиная с него
+ROLLUP_HISTORY_START = '''least((SELECT min(toDate(time)) FROM simulator_20250620.feed_actions),
+                               (SELECT min(toDate(time)) FROM simulator_20250620.message_actions))'''
+
+
+def apply_rollup_migrations():
+    db = ROLLUP_DATABASE
+
+    execute_clickhouse(query=f'''CREATE TABLE IF NOT EXISTS {db}.report_rollup_migrations (
+                                     version UInt32,
+                                     applied_at DateTime
+                                 )
+                                 ENGINE = MergeTree
+                                 ORDER BY version''', report='rollups', name='migrations_table')
+
+    df_applied = read_clickhouse(
+        query=f'SELECT version FROM {db}.report_rollup_migrations', report='rollups', name='migrations')
+    applied = set(df_applied['version'])
+
+    for version, migration in ROLLUP_MIGRATIONS:
+        if version in applied:
+            continue
+        logging.info('rollups: применяем миграцию %s', version)
+        execute_clickhouse(query=migration.format(db=db), report='rollups', name=f'migration_{version}')
+        execute_clickhouse(query=f'''INSERT INTO {db}.report_rollup_migrations
+                                     SELECT {version}, now()''', report='rollups', name='migration_log')
+
+
+def populate_rollups(date_from=None, date_to=None):
+    # По умолчанию досчитываем все непосчитанные дни с начала истории до
+    # вчерашнего, для бэкфилла передаем диапазон (пересчитывается целиком).
+    # Так пропущенный из-за ошибки день досчитается на следующем запуске
+    db = ROLLUP_DATABASE
+    apply_rollup_migrations()
+
+    if date_from is None:
+        df_days = read_clickhouse(
+            query=f'''WITH {ROLLUP_HISTORY_START} AS start
+                      SELECT day
+                      FROM (
+                            SELECT arrayJoin(arrayMap(i -> start + i,
+                                             range(toUInt32(dateDiff('day', start, yesterday()) + 1)))) AS day
+                           )
+                      WHERE day NOT IN (SELECT date FROM {db}.report_rollup_log)
+                      ORDER BY day''', report='rollups', name='missing_days')
+        days = pd.DatetimeIndex(pd.to_datetime(df_days['day']))
+    else:
+        yesterday = (datetime.now() - timedelta(days=1)).date()
+        days = pd.date_range(pd.to_datetime(date_from).date(),
+                             pd.to_datetime(date_to or yesterday).date())
+
+    # Недельная активность пересчитывается целиком по неделе, поэтому дни
+    # обрабатываются группами по неделям
+    weeks = pd.Series(days.strftime('%Y-%m-%d'),
+                      index=(days - pd.to_timedelta(days.dayofweek, unit='D')).strftime('%Y-%m-%d'))
+
+    for week, week_days in weeks.groupby(level=0):
+        for day in week_days:
+            logging.info('rollups: считаем %s', day)
+
+            # Сначала снимаем отметку о дне: если пересчет упадет после удаления
+            # данных, день не будет считаться посчитанным и отчеты прочитают сырые таблицы
+            execute_clickhouse(query=f'''ALTER TABLE {db}.report_rollup_log
+                                         DELETE WHERE date = '{day}'
+                                         SETTINGS mutations_sync = 2''', report='rollups', name='unlog_day')
+
+            # День пересчитывается целиком, поэтому повторный запуск не задваивает суммы
+            execute_clickhouse(query=f'''ALTER TABLE {db}.report_daily_source
+                                         DELETE WHERE date = '{day}'
+                                         SETTINGS mutations_sync = 2''', report='rollups', name='delete_day')
+
+            # Лента: уникальные пользователи, просмотры, лайки
+            execute_clickhouse(query=f'''INSERT INTO {db}.report_daily_source (date, source, platform, users, views, likes)
+                                         SELECT toDate(time) AS date,
+                                                source,
+                                                'feed' AS platform,
+                                                uniqExactState(toUInt64(user_id)) AS users,
+                                                sum(action = 'view') AS views,
+                                                sum(action = 'like') AS likes
+                                         FROM simulator_20250620.feed_actions
+                                         WHERE toDate(time) = '{day}'
+                                         GROUP BY date, source''', report='rollups', name='daily_feed')
+
+            # Мессенджер: уникальные отправители, сообщения, медиана сообщений на пользователя
+            execute_clickhouse(query=f'''INSERT INTO {db}.report_daily_source (date, source, platform, users, messages, messages_per_user)
+                                         SELECT date,
+                                                source,
+                                                'message' AS platform,
+                                                uniqExactState(user_id) AS users,
+                                                sum(sent_messages) AS messages,
+                                                quantileState(0.5)(sent_messages) AS messages_per_user
+                                         FROM (
+                                                 SELECT toDate(time) AS date,
+                                                        source,
+                                                        toUInt64(user_id) AS user_id,
+                                                        count(*) AS sent_messages
+                                                 FROM simulator_20250620.message_actions
+                                                 WHERE toDate(time) = '{day}'
+                                                 GROUP BY date, source, user_id
+                                              )
+                                         GROUP BY date, source''', report='rollups', name='daily_message')
+
+        # Недельная активность: пары (неделя, пользователь) пересчитываются по
+        # всей неделе, чтобы исправленные сырые данные не оставляли старых пар
+        execute_clickhouse(query=f'''ALTER TABLE {db}.report_weekly_user_activity
+                                     DELETE WHERE week = '{week}'
+                                     SETTINGS mutations_sync = 2''', report='rollups', name='delete_week')
+
+        execute_clickhouse(query=f'''INSERT INTO {db}.report_weekly_user_activity
+                                     SELECT DISTINCT toMonday(time)::date AS week,
+                                                     toUInt64(user_id) AS user_id
+                                     FROM simulator_20250620.feed_actions
+                                     WHERE toMonday(time)::date = '{week}'
+                                  ''', report='rollups', name='weekly_activity')
+
+        # Отметка о днях - только после того, как все их данные записаны
+        logged_days = ', '.join(f"'{day}'" for day in week_days)
+        execute_clickhouse(query=f'''INSERT INTO {db}.report_rollup_log
+                                     SELECT arrayJoin([{logged_days}])::date, now()''', report='rollups', name='log_days')
+
+
+def rollups_fresh(start=None):
+    if not USE_ROLLUPS:
+        return False
+
+    # Агрегаты свежие, если посчитан каждый день окна, которое читает отчет:
+    # с start (SQL-выражение, по умолчанию - первый день сырых таблиц) по вчера.
+    # Любая ошибка (нет таблиц, нет прав) - читаем сырые таблицы
+    if start is None:
+        start = ROLLUP_HISTORY_START
+
+    try:
+        df_fresh = read_clickhouse(
+            query=f'''SELECT countDistinct(date) = dateDiff('day', {start}, yesterday()) + 1 AS fresh
+                      FROM {ROLLUP_DATABASE}.report_rollup_log
+                      WHERE date BETWEEN {start} AND yesterday()''', report='rollups', name='fresh')
+    except Exception as e:
+        logging.warning('rollups: не удалось проверить свежесть агрегатов: %s', e)
+        return False
+
+    fresh = bool(df_fresh['fresh'].iloc[0])
+    if not fresh:
+        logging.warning('rollups: агрегаты посчитаны не за все дни окна, читаем сырые таблицы')
+    return fresh
+
+
+def format_estimate_note(mode, sampled_users, share_users, share_ads):
+    # Оценка погрешности для предварительного отчета (95%, ±1.96 стандартной ошибки)
+    if mode == 'sampled':
+        rate = 1 / REPORT_SAMPLE_MODULO
+        users_error = 1.96 * np.sqrt((1 - rate) / max(sampled_users, 1)) * 100
+        share_error = 1.96 * \
+            np.sqrt(share_ads * (1 - share_ads) / max(share_users, 1)) * 100
+        note = f'⚡ Предварительный отчет по выборке {rate:.0%} пользователей (cityHash64(user_id)).\n'
+        note += f'Погрешность (95%): количество пользователей ±{users_error:.2f}%, доли ±{share_error:.2f} п.п., '
+        note += f'медианы посчитаны по выборке.\n'
+    else:
+        # uniqCombined - HyperLogLog с 2^17 ячейками, стандартная ошибка 1.04 / sqrt(2^17)
+        users_error = 1.96 * 1.04 / np.sqrt(2 ** 17) * 100
+        note = f'⚡ Предварительный отчет по скетчам (uniqCombined, quantileTDigest).\n'
+        note += f'Погрешность (95%): количество пользователей и доли ±{users_error:.2f}%, '
+        note += f'медианы приближенные (t-digest).\n'
+    note += f'Точный отчет придет следом.'
+    return note
+
+
+def build_basic_information(chat_id, run_date=None, run_id=None, mode='exact'):
+    if mode not in REPORT_MODES:
+        raise ValueError(
+            f'Неизвестный режим отчета {mode!r}, ожидается один из {REPORT_MODES}')
+
+    # Датафреймы метрик сохраняются в outbox и хранилище артефактов как части
+    # basic/<имя>, предварительный отчет - basic/preview_<режим>_<имя>
+    prefix = 'basic/' if mode == 'exact' else f'basic/preview_{mode}_'
+
+    # Режим sampled: одинаковая выборка пользователей по хэшу в ленте и мессенджере,
+    # поэтому пользователь либо попадает в выборку на обеих платформах, либо нет
+    # Имя отчета для учета стоимости запросов: режимы сравниваются отдельно
+    report = 'basic' if mode == 'exact' else f'basic_{mode}'
+
+    if mode == 'sampled':
+        sample_filter = f'AND cityHash64(user_id) % {REPORT_SAMPLE_MODULO} = 0'
+        scale = REPORT_SAMPLE_MODULO
+    else:
+        sample_filter = ''
+        scale = 1
 
     # Надпись первая строка отчет на какую дату
     MONTHS_RU = {'January': 'января', 'February': 'февраля', 'March': 'марта', 'April': 'апреля', 'May': 'мая', 'June': 'июня',
@@ -52,30 +842,54 @@ def generate_basic_information(chat_id):
     # СОБИРАЕМ МЕТРИКИ
     # МЕТРИКА 1
     # метрика количество уникальных пользователей
-    total_users = '''WITH total_users AS (
-                                        SELECT DISTINCT user_id FROM simulator_20250620.feed_actions WHERE toDate(time) < today()
-                                        UNION ALL
-                                        SELECT DISTINCT user_id FROM simulator_20250620.message_actions WHERE toDate(time) < today()
-                                            )
-                         SELECT count(user_id) AS users
-                         FROM total_users'''
-
-    df_users = ph.read_clickhouse(query=total_users, connection=connection)
-    users = df_users['users'].iloc[0]
+    if mode == 'sketch':
+        total_users = '''SELECT (SELECT uniqCombined(user_id) FROM simulator_20250620.feed_actions WHERE toDate(time) < today())
+                              + (SELECT uniqCombined(user_id) FROM simulator_20250620.message_actions WHERE toDate(time) < today()) AS users'''
+    else:
+        total_users = f'''WITH total_users AS (
+                                            SELECT DISTINCT user_id FROM simulator_20250620.feed_actions WHERE toDate(time) < today() {sample_filter}
+                                            UNION ALL
+                                            SELECT DISTINCT user_id FROM simulator_20250620.message_actions WHERE toDate(time) < today() {sample_filter}
+                                                )
+                             SELECT count(user_id) AS users
+                             FROM total_users'''
+
+    df_users = outbox_artifact(run_date, run_id, chat_id, prefix + 'users',
+                               lambda: read_clickhouse(query=total_users, report=report, name='total_users'))
+    sampled_users = df_users['users'].iloc[0]
+    users = sampled_users * scale
 
     # МЕТРИКА 2
     # Метрика доля платных и органических пользователей
-    doly_organic_ads = '''SELECT DISTINCT user_id, source FROM simulator_20250620.feed_actions WHERE toDate(time) < today() 
-                          UNION ALL
-                          SELECT DISTINCT user_id, source FROM simulator_20250620.message_actions WHERE toDate(time) < today()'''
-
-    df_doly_organic_ads = ph.read_clickhouse(
-        query=doly_organic_ads, connection=connection)
-
-    # Подсчитываем количество пользователей по источникам
-    source_counts = df_doly_organic_ads.groupby(
-        'source')['user_id'].nunique().reset_index()
-    source_counts.columns = ['source', 'user_count']
+    if mode == 'sketch':
+        doly_organic_ads = '''SELECT source, uniqCombined(user_id) AS user_count
+                              FROM (
+                                    SELECT user_id, source FROM simulator_20250620.feed_actions WHERE toDate(time) < today()
+                                    UNION ALL
+                                    SELECT user_id, source FROM simulator_20250620.message_actions WHERE toDate(time) < today()
+                                   )
+                              GROUP BY source
+                              ORDER BY source'''
+
+        source_counts = outbox_artifact(run_date, run_id, chat_id, prefix + 'source_counts',
+                                        lambda: read_clickhouse(query=doly_organic_ads, report=report, name='doly_organic_ads'))
+    else:
+        doly_organic_ads = f'''SELECT DISTINCT user_id, source FROM simulator_20250620.feed_actions WHERE toDate(time) < today() {sample_filter}
+                              UNION ALL
+                              SELECT DISTINCT user_id, source FROM simulator_20250620.message_actions WHERE toDate(time) < today() {sample_filter}'''
+
+        def count_sources():
+            df_doly_organic_ads = read_clickhouse(
+                query=doly_organic_ads, report=report, name='doly_organic_ads')
+
+            # Подсчитываем количество пользователей по источникам
+            source_counts = df_doly_organic_ads.groupby(
+                'source')['user_id'].nunique().reset_index()
+            source_counts.columns = ['source', 'user_count']
+            return source_counts
+
+        source_counts = outbox_artifact(run_date, run_id, chat_id, prefix + 'source_counts',
+                                        count_sources)
 
     # Вычисляем доли
     total_users = source_counts['user_count'].sum()
@@ -88,48 +902,66 @@ def generate_basic_information(chat_id):
 
     # МЕТРИКА 3
     # Метрика Среднее (медиана) количество лайков и просмотров на 1 пользователя
-    average_user_like_view = '''SELECT user_id AS user,
+    average_user_like_view = f'''SELECT user_id AS user,
                                    source,
                                 sum(action = 'like') AS likes,
                                 sum(action = 'view') AS views
                             FROM simulator_20250620.feed_actions
-                            WHERE toDate(time) < today()
+                            WHERE toDate(time) < today() {sample_filter}
                             GROUP BY user_id, source'''
 
-    df_average_user_like_view = ph.read_clickhouse(
-        query=average_user_like_view, connection=connection)
+    def median_likes_views():
+        if mode == 'sketch':
+            # Медианы считаем на сервере, не выгружая строки по каждому пользователю
+            return read_clickhouse(
+                query=f'''SELECT source,
+                                 quantileTDigest(0.5)(likes) AS likes,
+                                 quantileTDigest(0.5)(views) AS views
+                          FROM ({average_user_like_view})
+                          GROUP BY source''', report=report, name='median_like_view')
 
-    median_like_ads = df_average_user_like_view[df_average_user_like_view['source'] == 'ads']['likes'].median(
-    )
-    median_like_ads = int(median_like_ads)
+        df_average_user_like_view = read_clickhouse(
+            query=average_user_like_view, report=report, name='average_user_like_view')
 
-    median_view_ads = df_average_user_like_view[df_average_user_like_view['source'] == 'ads']['views'].median(
-    )
-    median_view_ads = int(median_view_ads)
+        return df_average_user_like_view.groupby('source')[
+            ['likes', 'views']].median().reset_index()
 
-    median_like_organic = df_average_user_like_view[df_average_user_like_view['source'] == 'organic']['likes'].median(
-    )
-    median_like_organic = int(median_like_organic)
+    median_like_view = outbox_artifact(run_date, run_id, chat_id, prefix + 'median_like_view',
+                                       median_likes_views).set_index('source')
 
-    median_view_organic = df_average_user_like_view[df_average_user_like_view['source'] == 'organic']['views'].median(
-    )
-    median_view_organic = int(median_view_organic)
+    median_like_ads = int(median_like_view.loc['ads', 'likes'])
+    median_view_ads = int(median_like_view.loc['ads', 'views'])
+    median_like_organic = int(median_like_view.loc['organic', 'likes'])
+    median_view_organic = int(median_like_view.loc['organic', 'views'])
 
     # МЕТРИКА 4
     # Метрика Среднее (медиана) количество отправленых сообщений на 1 пользователя
-    average_sent_message_view = '''SELECT 
+    average_sent_message_view = f'''SELECT 
                                         user_id AS user,
                                         source,
                                         count(*) AS sent_messages
                                   FROM simulator_20250620.message_actions
-                                  WHERE toDate(time) < today()
+                                  WHERE toDate(time) < today() {sample_filter}
                                   GROUP BY user_id, source'''
 
-    df_average_sent_message_view = ph.read_clickhouse(
-        query=average_sent_message_view, connection=connection)
+    def median_messages():
+        if mode == 'sketch':
+            return read_clickhouse(
+                query=f'''SELECT source,
+                                 quantileTDigest(0.5)(sent_messages) AS sent_messages
+                          FROM ({average_sent_message_view})
+                          GROUP BY source
+                          ORDER BY source''', report=report, name='median_message').astype({'sent_messages': int})
+
+        df_average_sent_message_view = read_clickhouse(
+            query=average_sent_message_view, report=report, name='average_sent_message_view')
+
+        return df_average_sent_message_view.groupby(
+            'source')['sent_messages'].median().astype(int).reset_index()
+
+    median_message = outbox_artifact(run_date, run_id, chat_id, prefix + 'median_message',
+                                     median_messages)
 
-    median_message = df_average_sent_message_view.groupby(
-        'source')['sent_messages'].median().astype(int).reset_index()
     median_message_ads = median_message.iloc[0, 1]
     median_message_ogranic = median_message.iloc[1, 1]
 
@@ -157,161 +989,323 @@ def generate_basic_information(chat_id):
     message += f'- Платный трафик:  {median_message_ads}\n'
     message += f'- Органический трафик:  {median_message_ogranic}\n'
 
-    bot.sendMessage(chat_id=chat_id, text=message)
+    if mode != 'exact':
+        message += f'\n'
+        message += format_estimate_note(mode, sampled_users, total_users,
+                                        users_ads / 100)
+
+    return message
+
+
+def generate_basic_information(chat_id, run_date=None, run_id=None, mode=None):
+    bot = telegram.Bot(token=BOT_TOKEN)
+
+    if mode is None:
+        mode = REPORT_MODE
+
+    # Предварительный и точный отчеты - разные части одного запуска в outbox
+    part = 'basic/message' if mode == 'exact' else f'basic/preview_{mode}'
+
+    message = outbox_artifact(run_date, run_id, chat_id, part,
+                              lambda: build_basic_information(chat_id, run_date, run_id, mode))
+
+    outbox_send_message(bot, chat_id, run_id, part, message)
+
+
+# ============================================================================
+# ШАБЛОНЫ ГРАФИКОВ
+# ============================================================================
+
+# Статичная часть каждой компоновки: размер фигуры, сетка осей, заголовки,
+# подписи осей и поворот подписей. Строится один раз на компоновку, при каждом
+# рендере обновляются только данные.
+PLOT_LAYOUTS = {
+    'report': {
+        'figsize': (16, 14),
+        'suptitle': ('Графики метрик', 0.98),
+        'tight_layout': True,
+        'axes': [
+            {'grid': (3, 2, (1, 2)), 'title': 'Количество уникальных пользователей на обеих платформах',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество пользователей', 'rotation': 0},
+            {'grid': (3, 2, 3), 'title': 'Количество лайков в ленте новостей',
+             'fontsize': 12, 'xlabel': 'Дата', 'ylabel': 'Количество лайков', 'rotation': 0},
+            {'grid': (3, 2, 4), 'title': 'Количество просмотров в ленте новостей',
+             'fontsize': 12, 'xlabel': 'Дата', 'ylabel': 'Количество просмотров', 'rotation': 0},
+            {'grid': (3, 2, 5), 'title': 'Количество отправленных сообщений в мессенджере',
+             'fontsize': 12, 'xlabel': 'Дата', 'ylabel': 'Количество отправленых сообщений', 'rotation': 0},
+            {'grid': (3, 2, 6), 'title': 'Количество пользователей отправивших сообщения в мессенджере',
+             'fontsize': 12, 'xlabel': 'Дата', 'ylabel': 'Количество пользователей', 'rotation': 0},
+        ],
+    },
+    'audience': {
+        'figsize': (14, 7),
+        'suptitle': None,
+        'tight_layout': False,
+        'axes': [
+            {'grid': (1, 1, 1), 'title': 'Динамика пользователей по статусам (ушедшие, старые, новые)',
+             'fontsize': 14, 'xlabel': 'Неделя', 'ylabel': 'Количество пользователей', 'rotation': 45},
+        ],
+    },
+    'lenta': {
+        'figsize': (16, 14),
+        'suptitle': ('Графики метрик в ленте новостей за предыдущую неделю', 1),
+        'tight_layout': True,
+        'axes': [
+            {'grid': (2, 2, 1), 'title': 'Количество уникальных пользователей',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество пользователей', 'rotation': 45},
+            {'grid': (2, 2, 2), 'title': 'Количество лайков',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество лайков', 'rotation': 45},
+            {'grid': (2, 2, 3), 'title': 'Количество просмотров',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество просмотров', 'rotation': 45},
+            {'grid': (2, 2, 4), 'title': 'CTR',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'CTR', 'rotation': 45},
+        ],
+    },
+    'message': {
+        'figsize': (16, 14),
+        'suptitle': ('Графики метрик предыдущую неделю', 1),
+        'tight_layout': True,
+        'axes': [
+            {'grid': (2, 2, 1), 'title': 'Количество уникальных пользователей',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество пользователей', 'rotation': 45},
+            {'grid': (2, 2, 2), 'title': 'Количество отправленных сообщений',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество отправленных сообщений', 'rotation': 45},
+            {'grid': (2, 2, 3), 'title': 'Среднее на одного пользователя',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество отправленых сообщений', 'rotation': 45},
+            {'grid': (2, 2, 4), 'title': 'Медиана на одного пользователя',
+             'fontsize': 14, 'xlabel': 'Дата', 'ylabel': 'Количество отправленых сообщений', 'rotation': 45},
+        ],
+    },
+}
+
+# Кэш готовых шаблонов: имя компоновки -> шаблон
+PLOT_TEMPLATES = {}
+PLOT_TEMPLATES_LOCK = threading.Lock()
 
 
-def send_plot(df_dau_source, df_like_views_source, df_sent_message, bot, chat_id):
+def build_plot_template(layout):
+    spec = PLOT_LAYOUTS[layout]
 
-    # Создаём фигуру с компоновкой: 1 график сверху, 2x2 снизу
-    fig = plt.figure(figsize=(16, 14))
+    # Фигура создается без pyplot, поэтому не попадает в глобальный список фигур
+    fig = Figure(figsize=spec['figsize'])
+    FigureCanvasAgg(fig)
 
-    # Создаём сетку: 3 ряда, 2 колонки
-    # Первый график занимает всю ширину (span=2)
-    ax1 = plt.subplot(3, 2, (1, 2))  # Первый график на всю ширину
+    axes = []
+    for ax_spec in spec['axes']:
+        ax = fig.add_subplot(*ax_spec['grid'])
+        ax.set_title(ax_spec['title'], fontsize=ax_spec['fontsize'],
+                     fontweight='bold')
+        ax.set_xlabel(ax_spec['xlabel'])
+        ax.set_ylabel(ax_spec['ylabel'])
+        ax.tick_params(axis='x', rotation=ax_spec['rotation'])
+        axes.append(ax)
 
-    # Остальные 4 графика в сетке 2x2
-    ax2 = plt.subplot(3, 2, 3)  # Второй график
-    ax3 = plt.subplot(3, 2, 4)  # Третий график
-    ax4 = plt.subplot(3, 2, 5)  # Четвёртый график
-    ax5 = plt.subplot(3, 2, 6)  # Пятый график
+    # Общий заголовок
+    if spec['suptitle'] is not None:
+        text, y = spec['suptitle']
+        fig.suptitle(text, fontsize=16, fontweight='bold', y=y)
+
+    return {
+        'figure': fig,
+        'axes': axes,
+        # отступы считаются один раз, на первом рендере с реальными данными
+        'layout_ready': not spec['tight_layout'],
+        'lock': threading.Lock(),
+    }
+
+
+def get_plot_template(layout):
+    with PLOT_TEMPLATES_LOCK:
+        if layout not in PLOT_TEMPLATES:
+            PLOT_TEMPLATES[layout] = build_plot_template(layout)
+        return PLOT_TEMPLATES[layout]
+
+
+def clear_plot_template(template):
+    # Удаляем только данные прошлого рендера, заголовки и подписи остаются
+    for ax in template['axes']:
+        for container in list(ax.containers):
+            container.remove()
+        for artist in list(ax.lines) + list(ax.patches) + list(ax.collections):
+            artist.remove()
+        legend = ax.get_legend()
+        if legend is not None:
+            legend.remove()
+
+        # Сбрасываем категории оси X (даты-строки) и пределы от прошлых данных
+        ax.xaxis.units = None
+        ax.ignore_existing_data_limits = True
+        ax.set_autoscale_on(True)
+
+
+def render_plot_template(layout, draw_func, frames, use_template=None, fmt='png'):
+    if use_template is None:
+        use_template = USE_PLOT_TEMPLATES
+
+    if use_template:
+        template = get_plot_template(layout)
+    else:
+        template = build_plot_template(layout)
+
+    with template['lock']:
+        clear_plot_template(template)
+        draw_func(template['axes'], *frames)
+
+        # Настраиваем отступы
+        if not template['layout_ready']:
+            template['figure'].tight_layout()
+            template['layout_ready'] = True
+
+        plot_object = io.BytesIO()
+        template['figure'].savefig(plot_object, format=fmt, dpi=300, bbox_inches='tight')
+
+    plot_object.seek(0)
+    return plot_object
+
+
+def draw_plot(axes, df_dau_source, df_like_views_source, df_sent_message):
+    ax1, ax2, ax3, ax4, ax5 = axes
 
     # График 1: DAU по источникам (большой, сверху)
     sns.lineplot(data=df_dau_source, x='date', y='dau', hue='source',
                  marker='o', ax=ax1)
-    ax1.set_title('Количество уникальных пользователей на обеих платформах',
-                  fontsize=14, fontweight='bold')
-    ax1.set_xlabel('Дата')
-    ax1.set_ylabel('Количество пользователей')
-    ax1.tick_params(axis='x', rotation=0)
 
     # График 2: Лайки по источникам
     sns.lineplot(data=df_like_views_source, x='date', y='likes', hue='source',
                  marker='s', ax=ax2)
-    ax2.set_title('Количество лайков в ленте новостей',
-                  fontsize=12, fontweight='bold')
-    ax2.set_xlabel('Дата')
-    ax2.set_ylabel('Количество лайков')
-    ax2.tick_params(axis='x', rotation=0)
 
     # График 3: Просмотры по источникам
     sns.lineplot(data=df_like_views_source, x='date', y='views', hue='source',
                  marker='^', ax=ax3)
-    ax3.set_title('Количество просмотров в ленте новостей',
-                  fontsize=12, fontweight='bold')
-    ax3.set_xlabel('Дата')
-    ax3.set_ylabel('Количество просмотров')
-    ax3.tick_params(axis='x', rotation=0)
 
     # График 4: Количество отправленных сообщений по источникам
     sns.lineplot(data=df_sent_message, x='date', y='sent_messages', hue='source',
                  marker='d', ax=ax4)
-    ax4.set_title('Количество отправленных сообщений в мессенджере',
-                  fontsize=12, fontweight='bold')
-    ax4.set_xlabel('Дата')
-    ax4.set_ylabel('Количество отправленых сообщений')
-    ax4.tick_params(axis='x', rotation=0)
 
     # График 5: Количество пользователей по источникам
     sns.lineplot(data=df_sent_message, x='date', y='unique_senders', hue='source',
                  marker='*', ax=ax5)
-    ax5.set_title('Количество пользователей отправивших сообщения в мессенджере',
-                  fontsize=12, fontweight='bold')
-    ax5.set_xlabel('Дата')
-    ax5.set_ylabel('Количество пользователей')
-    ax5.tick_params(axis='x', rotation=0)
 
-    # Общий заголовок
-    fig.suptitle('Графики метрик', fontsize=16, fontweight='bold', y=0.98)
 
-    # Настраиваем отступы
-    plt.tight_layout()
+def send_plot(df_dau_source, df_like_views_source, df_sent_message, bot, chat_id, run_date=None, run_id=None):
 
-    # Сохраняем и отправляем
-    plot_object = io.BytesIO()
-    plt.savefig(plot_object, dpi=300, bbox_inches='tight')
-    plot_object.seek(0)
-    plot_object.name = 'full_report_5_graphs.png'
-    plt.close()
+    outbox_send_message(bot, chat_id, run_id, 'report/plot_title',
+                        "📊 Графики метрик")
 
-    bot.sendMessage(chat_id=chat_id, text="📊 Графики метрик")
-    bot.sendPhoto(chat_id=chat_id, photo=plot_object)
+    # Компоновка: 1 график сверху на всю ширину, 2x2 снизу
+    outbox_send_photo(bot, chat_id, run_date, run_id, 'report/plot',
+                      lambda fmt='png': render_plot('report', (df_dau_source, df_like_views_source, df_sent_message), fmt),
+                      'full_report_5_graphs.png')
 
 
-def send_plot_audience(df_action_audience, bot, chat_id):
-    plt.figure(figsize=(14, 7))
+def draw_plot_audience(axes, df_action_audience):
+    ax1, = axes
 
     sns.barplot(data=df_action_audience, x='this_week',
-                y='users_count', hue='status')
+                y='users_count', hue='status', ax=ax1)
 
-    plt.title('Динамика пользователей по статусам (ушедшие, старые, новые)',
-              fontsize=14, fontweight='bold')
-    plt.xlabel('Неделя')
-    plt.ylabel('Количество пользователей')
-    plt.xticks(rotation=45)
 
-    # Сохраняем и отправляем
-    plot_object_1 = io.BytesIO()
-    plt.savefig(plot_object_1, dpi=300, bbox_inches='tight')
-    plot_object_1.seek(0)
-    plot_object_1.name = 'full_report_audience.png'
-    plt.close()
+def send_plot_audience(df_action_audience, bot, chat_id, run_date=None, run_id=None):
+    outbox_send_message(bot, chat_id, run_id, 'report/audience_title',
+                        "📊 График активная аудитория по неделям")
 
-    bot.sendMessage(chat_id=chat_id,
-                    text="📊 График активная аудитория по неделям")
-    bot.sendPhoto(chat_id=chat_id, photo=plot_object_1)
+    outbox_send_photo(bot, chat_id, run_date, run_id, 'report/audience',
+                      lambda fmt='png': render_plot('audience', (df_action_audience,), fmt),
+                      'full_report_audience.png')
 
 
-def generate_report_plot(chat_id):
+def generate_report_plot(chat_id, run_date=None, run_id=None):
     bot = telegram.Bot(token=BOT_TOKEN)
 
-    # График 1 - DAU с разделенеим трафика на платных и органику
-    graphics_DAU_source = '''SELECT toDate(time) AS date, 
-                               source,
-                               count(DISTINCT user_id) AS dau
-                        FROM (
-                            SELECT user_id, time, source FROM simulator_20250620.feed_actions WHERE toDate(time) < today()
-                            UNION ALL
-                            SELECT user_id, time, source FROM simulator_20250620.message_actions WHERE toDate(time) < today()
-                        ) combined_actions
-                        GROUP BY date, source
-                        ORDER BY date, source'''
-
-    df_dau_source = ph.read_clickhouse(
-        query=graphics_DAU_source, connection=connection)
+    # Читаем из агрегатов, если посчитана вся история, иначе из сырых таблиц
+    use_rollups = rollups_fresh()
+    db = ROLLUP_DATABASE
 
-    # График 2 - Лайки и просмотры с разделенеим трафика на платных и органику
-    graphics_like_views_source = '''SELECT toDate(time) AS date, 
+    # График 1 - DAU с разделенеим трафика на платных и органику
+    if use_rollups:
+        graphics_DAU_source = f'''SELECT date,
                                         source,
-                                        sum(action = 'like') AS likes,
-                                        sum(action = 'view') AS views
-                                  FROM simulator_20250620.feed_actions
-                                  WHERE toDate(time) < today()
-                                  GROUP BY date, source
-                                  ORDER BY date, source'''
+                                        uniqExactMerge(users) AS dau
+                                 FROM {db}.report_daily_source
+                                 WHERE date < today()
+                                 GROUP BY date, source
+                                 ORDER BY date, source'''
+    else:
+        graphics_DAU_source = '''SELECT toDate(time) AS date, 
+                                   source,
+                                   count(DISTINCT user_id) AS dau
+                            FROM (
+                                SELECT user_id, time, source FROM simulator_20250620.feed_actions WHERE toDate(time) < today()
+                                UNION ALL
+                                SELECT user_id, time, source FROM simulator_20250620.message_actions WHERE toDate(time) < today()
+                            ) combined_actions
+                            GROUP BY date, source
+                            ORDER BY date, source'''
+
+    df_dau_source = outbox_artifact(run_date, run_id, chat_id, 'report/dau_source',
+                                    lambda: read_clickhouse(query=graphics_DAU_source, report='report', name='dau_source'))
 
-    df_like_views_source = ph.read_clickhouse(
-        query=graphics_like_views_source, connection=connection)
+    # График 2 - Лайки и просмотры с разделенеим трафика на платных и органику
+    if use_rollups:
+        graphics_like_views_source = f'''SELECT date,
+                                               source,
+                                               sum(likes) AS likes,
+                                               sum(views) AS views
+                                        FROM {db}.report_daily_source
+                                        WHERE platform = 'feed' AND date < today()
+                                        GROUP BY date, source
+                                        ORDER BY date, source'''
+    else:
+        graphics_like_views_source = '''SELECT toDate(time) AS date, 
+                                            source,
+                                            sum(action = 'like') AS likes,
+                                            sum(action = 'view') AS views
+                                      FROM simulator_20250620.feed_actions
+                                      WHERE toDate(time) < today()
+                                      GROUP BY date, source
+                                      ORDER BY date, source'''
+
+    df_like_views_source = outbox_artifact(run_date, run_id, chat_id, 'report/like_views_source',
+                                           lambda: read_clickhouse(query=graphics_like_views_source, report='report', name='like_views_source'))
 
     # График 3 - Отправление сообщения с разделенеим трафика на платных и органику
-    graphics_sent_message = '''SELECT toDate(time) AS date, 
-                                      source,
-                                      count(*) AS sent_messages,
-                                      count(DISTINCT user_id) AS unique_senders
-                               FROM simulator_20250620.message_actions
-                               WHERE toDate(time) < today()
-                               GROUP BY date, source
-                               ORDER BY date, source'''
-
-    df_sent_message = ph.read_clickhouse(
-        query=graphics_sent_message, connection=connection)
+    if use_rollups:
+        graphics_sent_message = f'''SELECT date,
+                                          source,
+                                          sum(messages) AS sent_messages,
+                                          uniqExactMerge(users) AS unique_senders
+                                   FROM {db}.report_daily_source
+                                   WHERE platform = 'message' AND date < today()
+                                   GROUP BY date, source
+                                   ORDER BY date, source'''
+    else:
+        graphics_sent_message = '''SELECT toDate(time) AS date, 
+                                          source,
+                                          count(*) AS sent_messages,
+                                          count(DISTINCT user_id) AS unique_senders
+                                   FROM simulator_20250620.message_actions
+                                   WHERE toDate(time) < today()
+                                   GROUP BY date, source
+                                   ORDER BY date, source'''
+
+    df_sent_message = outbox_artifact(run_date, run_id, chat_id, 'report/sent_message',
+                                      lambda: read_clickhouse(query=graphics_sent_message, report='report', name='sent_message'))
 
     # График 4 - Старые, новые, ушедшие пользователи по неделям
-    graphics_action_audience = '''WITH weeks_data AS (
-                                                    SELECT DISTINCT user_id,
-                                                           toMonday(time)::date AS week
-                                                    FROM simulator_20250620.feed_actions
-                                                    WHERE toMonday(time)::date < toMonday(today())  -- исключаем текущую неделю
-                                                    ),
+    if use_rollups:
+        weeks_data = f'''SELECT DISTINCT user_id,
+                                week
+                         FROM {db}.report_weekly_user_activity
+                         WHERE week < toMonday(today())  -- исключаем текущую неделю
+                      '''
+    else:
+        weeks_data = '''SELECT DISTINCT user_id,
+                               toMonday(time)::date AS week
+                        FROM simulator_20250620.feed_actions
+                        WHERE toMonday(time)::date < toMonday(today())  -- исключаем текущую неделю
+                     '''
+
+    graphics_action_audience = f'''WITH weeks_data AS ({weeks_data}),
 
                                        user_weeks_visited AS (
                                                     SELECT
@@ -345,8 +1339,8 @@ def generate_report_plot(chat_id):
                                     GROUP BY this_week, previous_week, status
                                     ORDER BY this_week, status'''
 
-    df_action_audience = ph.read_clickhouse(
-        query=graphics_action_audience, connection=connection)
+    df_action_audience = outbox_artifact(run_date, run_id, chat_id, 'report/action_audience',
+                                         lambda: read_clickhouse(query=graphics_action_audience, report='report', name='action_audience'))
     # df_action_audience['this_week'] = pd.to_datetime(df_action_audience['this_week'])
     # df_action_audience['previous_week'] = pd.to_datetime(df_action_audience['previous_week'])
     df_action_audience = df_action_audience.sort_values(
@@ -354,7 +1348,8 @@ def generate_report_plot(chat_id):
 
     # Проверяем данные  # ТУТ ЕСЛИ ПРИДЕТ ПУСТОЙ ДАТАФРЕМ ТО У НАС НЕ СЛОМАЕТСЯ ДАГ А ПРИДЕТ ПРОСТО СООБЩЕНИЕ ЧТО НЕТ ДАННЫХ
     if df_dau_source.empty or df_like_views_source.empty or df_sent_message.empty:
-        bot.sendMessage(chat_id=chat_id, text="Нет данных для отчёта.")
+        outbox_send_message(bot, chat_id, run_id, 'report/no_data',
+                            "Нет данных для отчёта.")
         return
 
     # Конвертируем даты
@@ -366,85 +1361,53 @@ def generate_report_plot(chat_id):
 
     # Вызов функции где будут строится графики передаем 3 датафрейма, номер чата в телеграме, имя бота
     send_plot(df_dau_source, df_like_views_source,
-              df_sent_message, bot, chat_id)
-
-    send_plot_audience(df_action_audience, bot, chat_id)
-
+              df_sent_message, bot, chat_id, run_date, run_id)
 
-def send_plot_lenta(df_block_lenta, bot, chat_id):
+    send_plot_audience(df_action_audience, bot, chat_id, run_date, run_id)
 
-    # Создаём фигуру с компоновкой: 1 график сверху, 2x2 снизу
-    fig = plt.figure(figsize=(16, 14))
 
-    # Создаём сетку: 2 ряда, 2 колонки
-    ax1 = plt.subplot(2, 2, 1)  # Первый график
-    ax2 = plt.subplot(2, 2, 2)  # Второй график
-    ax3 = plt.subplot(2, 2, 3)  # Третий график
-    ax4 = plt.subplot(2, 2, 4)  # Четвёртый график
+def draw_plot_lenta(axes, df_block_lenta):
+    ax1, ax2, ax3, ax4 = axes
 
     # График 1: DAU
     sns.barplot(data=df_block_lenta, x='event_date',
                 y='dau', ax=ax1, color='#4c72b0')
-    ax1.set_title('Количество уникальных пользователей',
-                  fontsize=14, fontweight='bold')
-    ax1.set_xlabel('Дата')
-    ax1.set_ylabel('Количество пользователей')
-    ax1.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax1.set_ylim(0, df_block_lenta['dau'].max() * 1.8)
 
     # График 2: Лайки
     sns.lineplot(data=df_block_lenta, x='event_date',
                  y='likes', ax=ax2, color='#4c72b0')
-    ax2.set_title('Количество лайков', fontsize=14, fontweight='bold')
-    ax2.set_xlabel('Дата')
-    ax2.set_ylabel('Количество лайков')
-    ax2.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax2.set_ylim(0, df_block_lenta['likes'].max() * 1.2)
 
     # График 3: Просмотры по источникам
     sns.lineplot(data=df_block_lenta, x='event_date',
                  y='views', ax=ax3, color='#4c72b0')
-    ax3.set_title('Количество просмотров', fontsize=14, fontweight='bold')
-    ax3.set_xlabel('Дата')
-    ax3.set_ylabel('Количество просмотров')
-    ax3.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax3.set_ylim(0, df_block_lenta['views'].max() * 1.2)
 
     # График 4: CTR
     sns.barplot(data=df_block_lenta, x='event_date',
                 y='CTR', ax=ax4, color='#4c72b0')
-    ax4.set_title('CTR', fontsize=14, fontweight='bold')
-    ax4.set_xlabel('Дата')
-    ax4.set_ylabel('CTR')
-    ax4.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax4.set_ylim(0, df_block_lenta['CTR'].max() * 1.8)
 
-    # Общий заголовок
-    fig.suptitle('Графики метрик в ленте новостей за предыдущую неделю',
-                 fontsize=16, fontweight='bold', y=1)
-
-    # Настраиваем отступы
-    plt.tight_layout()
 
-    # Сохраняем и отправляем
-    plot_object = io.BytesIO()
-    plt.savefig(plot_object, dpi=300, bbox_inches='tight')
-    plot_object.seek(0)
-    plot_object.name = 'lenta_report_graphs.png'
-    plt.close()
+def send_plot_lenta(df_block_lenta, bot, chat_id, run_date=None, run_id=None):
 
     diapazon = f"c {df_block_lenta['event_date'].min()} по {df_block_lenta['event_date'].max()}"
 
-    bot.sendMessage(chat_id=chat_id,
-                    text=f"📊 Графики метрик в ленте новостей {diapazon}")
-    bot.sendPhoto(chat_id=chat_id, photo=plot_object)
+    outbox_send_message(bot, chat_id, run_id, 'lenta/plot_title',
+                        f"📊 Графики метрик в ленте новостей {diapazon}")
+
+    # Компоновка: сетка 2x2
+    outbox_send_photo(bot, chat_id, run_date, run_id, 'lenta/plot',
+                      lambda fmt='png': render_plot('lenta', (df_block_lenta,), fmt),
+                      'lenta_report_graphs.png')
 
 
-def generate_lenta_information(chat_id):
+def generate_lenta_information(chat_id, run_date=None, run_id=None):
     bot = telegram.Bot(token=BOT_TOKEN)
 
     # Надпись первая строка отчет на какую дату
@@ -462,23 +1425,37 @@ def generate_lenta_information(chat_id):
     # СОБИРАЕМ МЕТРИКИ по ленте за вчера и неделю назад
     # МЕТРИКА 1 - 4
     # метрика DAU, like, view, CTR
-    block_lenta = '''SELECT 
-                        toDate(time) AS event_date,
-                        count(DISTINCT user_id) AS dau,
-                        sum(action = 'view') AS views,
-                        sum(action = 'like') AS likes,
-                        sum(action = 'like') / sum(action = 'view') AS CTR
-                    FROM simulator_20250620.feed_actions
-                    WHERE toDate(time) BETWEEN today() - 8 AND yesterday()
-                    GROUP BY event_date
-                    ORDER BY event_date;'''
-
-    df_block_lenta = ph.read_clickhouse(
-        query=block_lenta, connection=connection)
+    # Читаем из агрегатов, если посчитан каждый день окна, иначе из сырых таблиц
+    if rollups_fresh('today() - 8'):
+        block_lenta = f'''SELECT
+                            date AS event_date,
+                            uniqExactMerge(users) AS dau,
+                            sum(views) AS views,
+                            sum(likes) AS likes,
+                            likes / views AS CTR
+                        FROM {ROLLUP_DATABASE}.report_daily_source
+                        WHERE platform = 'feed' AND date BETWEEN today() - 8 AND yesterday()
+                        GROUP BY event_date
+                        ORDER BY event_date;'''
+    else:
+        block_lenta = '''SELECT 
+                            toDate(time) AS event_date,
+                            count(DISTINCT user_id) AS dau,
+                            sum(action = 'view') AS views,
+                            sum(action = 'like') AS likes,
+                            sum(action = 'like') / sum(action = 'view') AS CTR
+                        FROM simulator_20250620.feed_actions
+                        WHERE toDate(time) BETWEEN today() - 8 AND yesterday()
+                        GROUP BY event_date
+                        ORDER BY event_date;'''
+
+    df_block_lenta = outbox_artifact(run_date, run_id, chat_id, 'lenta/block',
+                                     lambda: read_clickhouse(query=block_lenta, report='lenta', name='block'))
 
     # Проверяем данные  # ТУТ ЕСЛИ ПРИДЕТ ПУСТОЙ ДАТАФРЕМ ТО У НАС НЕ СЛОМАЕТСЯ ДАГ А ПРИДЕТ ПРОСТО СООБЩЕНИЕ ЧТО НЕТ ДАННЫХ
     if df_block_lenta.empty:
-        bot.sendMessage(chat_id=chat_id, text="Нет данных для отчёта.")
+        outbox_send_message(bot, chat_id, run_id, 'lenta/no_data',
+                            "Нет данных для отчёта.")
         return
 
     # Конвертируем даты
@@ -524,42 +1501,24 @@ def generate_lenta_information(chat_id):
     message += f'- Количество лайков: {yesterday_like} ({format_change(delta_like)})\n'
     message += f'- CTR: {yesterday_CTR}% ({format_change(delta_CTR, is_pp=True)})\n'
 
-    bot.sendMessage(chat_id=chat_id, text=message)
+    outbox_send_message(bot, chat_id, run_id, 'lenta/message', message)
 
     # Вызов функции где будут строится графики передаем
-    send_plot_lenta(df_block_lenta, bot, chat_id)
+    send_plot_lenta(df_block_lenta, bot, chat_id, run_date, run_id)
 
 
-def send_plot_message(df_block_message, bot, chat_id):
-
-    # Создаём фигуру с компоновкой: 1 график сверху, 2x2 снизу
-    fig = plt.figure(figsize=(16, 14))
-
-    # Создаём сетку: 2 ряда, 2 колонки
-    ax1 = plt.subplot(2, 2, 1)  # Первый график
-    ax2 = plt.subplot(2, 2, 2)  # Второй график
-    ax3 = plt.subplot(2, 2, 3)  # Третий график
-    ax4 = plt.subplot(2, 2, 4)  # Четвёртый график
+def draw_plot_message(axes, df_block_message):
+    ax1, ax2, ax3, ax4 = axes
 
     # График 1: DAU
     sns.barplot(data=df_block_message, x='event_date',
                 y='dau', ax=ax1, color='#4c72b0')
-    ax1.set_title('Количество уникальных пользователей',
-                  fontsize=14, fontweight='bold')
-    ax1.set_xlabel('Дата')
-    ax1.set_ylabel('Количество пользователей')
-    ax1.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax1.set_ylim(0, df_block_message['dau'].max() * 1.2)
 
     # График 2: Отправленные сообщения
     sns.lineplot(data=df_block_message, x='event_date',
                  y='messages_sent', ax=ax2, color='#4c72b0')
-    ax2.set_title('Количество отправленных сообщений',
-                  fontsize=14, fontweight='bold')
-    ax2.set_xlabel('Дата')
-    ax2.set_ylabel('Количество отправленных сообщений')
-    ax2.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax2.set_ylim(0, df_block_message['messages_sent'].max() * 1.2)
 
@@ -570,47 +1529,30 @@ def send_plot_message(df_block_message, bot, chat_id):
     # График 3: Среднее на пользователя
     sns.lineplot(data=df_block_message, x='event_date',
                  y='avg_per_user', ax=ax3, color='#4c72b0')
-    ax3.set_title('Среднее на одного пользователя',
-                  fontsize=14, fontweight='bold')
-    ax3.set_xlabel('Дата')
-    ax3.set_ylabel('Количество отправленых сообщений')
-    ax3.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax3.set_ylim(0, df_block_message['avg_per_user'].max() * 1.2)
 
     # График 4: Медиана на пользователя
     sns.lineplot(data=df_block_message, x='event_date',
                  y='median_per_user', ax=ax4, color='#4c72b0')
-    ax4.set_title('Медиана на одного пользователя',
-                  fontsize=14, fontweight='bold')
-    ax4.set_xlabel('Дата')
-    ax4.set_ylabel('Количество отправленых сообщений')
-    ax4.tick_params(axis='x', rotation=45)
     # Добавь отступ по оси Y:
     ax4.set_ylim(0, df_block_message['median_per_user'].max() * 1.2)
 
-    # Общий заголовок
-    fig.suptitle('Графики метрик предыдущую неделю',
-                 fontsize=16, fontweight='bold', y=1)
 
-    # Настраиваем отступы
-    plt.tight_layout()
-
-    # Сохраняем и отправляем
-    plot_object = io.BytesIO()
-    plt.savefig(plot_object, dpi=300, bbox_inches='tight')
-    plot_object.seek(0)
-    plot_object.name = 'message_report_graphs.png'
-    plt.close()
+def send_plot_message(df_block_message, bot, chat_id, run_date=None, run_id=None):
 
     diapazon = f"c {df_block_message['event_date'].min()} по {df_block_message['event_date'].max()}"
 
-    bot.sendMessage(chat_id=chat_id,
-                    text=f"📊 Графики по метрикам в мессенджере {diapazon}")
-    bot.sendPhoto(chat_id=chat_id, photo=plot_object)
+    outbox_send_message(bot, chat_id, run_id, 'message/plot_title',
+                        f"📊 Графики по метрикам в мессенджере {diapazon}")
 
+    # Компоновка: сетка 2x2
+    outbox_send_photo(bot, chat_id, run_date, run_id, 'message/plot',
+                      lambda fmt='png': render_plot('message', (df_block_message,), fmt),
+                      'message_report_graphs.png')
 
-def generate_message_information(chat_id):
+
+def generate_message_information(chat_id, run_date=None, run_id=None):
     bot = telegram.Bot(token=BOT_TOKEN)
 
     # Надпись первая строка отчет на какую дату
@@ -628,52 +1570,66 @@ def generate_message_information(chat_id):
     # СОБИРАЕМ МЕТРИКИ по сообщениям за вчера и неделю назад
     # МЕТРИКА 1 - 4
     # метрика DAU, messages_sent, median_per_user, avg_per_user
-    message_information = '''-- Подзапрос 1: считаем общие метрики
-                        WITH main_stats AS (
-                                            SELECT 
-                                                    toDate(time) AS event_date,
-                                                    count(*) AS messages_sent,
-                                                    count(DISTINCT user_id) AS dau,
-                                                    round(count(*) / count(DISTINCT user_id), 2) AS avg_per_user
-                                            FROM simulator_20250620.message_actions
-                                            WHERE toDate(time) BETWEEN today() - 8 AND yesterday()
-                                            GROUP BY event_date
-                                                    ),
-
-                    -- Подзапрос 2: считаем медиану по пользователям за каждый день
-                                medians AS (
-                                            SELECT 
-                                                    event_date,
-                                                    quantile(0.5)(sent_messages) AS median_per_user
-                                            FROM (
-                                                    SELECT 
+    # Читаем из агрегатов, если посчитан каждый день окна, иначе из сырых таблиц
+    if rollups_fresh('today() - 8'):
+        message_information = f'''SELECT
+                                    date AS event_date,
+                                    sum(messages) AS messages_sent,
+                                    uniqExactMerge(users) AS dau,
+                                    round(sum(messages) / uniqExactMerge(users), 2) AS avg_per_user,
+                                    quantileMerge(0.5)(messages_per_user) AS median_per_user
+                                FROM {ROLLUP_DATABASE}.report_daily_source
+                                WHERE platform = 'message' AND date BETWEEN today() - 8 AND yesterday()
+                                GROUP BY event_date
+                                ORDER BY event_date;'''
+    else:
+        message_information = '''-- Подзапрос 1: считаем общие метрики
+                            WITH main_stats AS (
+                                                SELECT 
                                                         toDate(time) AS event_date,
-                                                        user_id,
-                                                        count(*) AS sent_messages
-                                                    FROM simulator_20250620.message_actions
-                                                    WHERE toDate(time) BETWEEN today() - 8 AND yesterday()
-                                                    GROUP BY event_date, user_id
-                                                    )
-                                            GROUP BY event_date
-                                            )
-
-                    -- Объединяем
-                        SELECT 
-                            m.event_date,
-                            m.messages_sent,
-                            m.dau,
-                            m.avg_per_user,
-                            med.median_per_user
-                        FROM main_stats AS m
-                        JOIN medians AS med ON m.event_date = med.event_date
-                        ORDER BY m.event_date;'''
-
-    df_block_message = ph.read_clickhouse(
-        query=message_information, connection=connection)
+                                                        count(*) AS messages_sent,
+                                                        count(DISTINCT user_id) AS dau,
+                                                        round(count(*) / count(DISTINCT user_id), 2) AS avg_per_user
+                                                FROM simulator_20250620.message_actions
+                                                WHERE toDate(time) BETWEEN today() - 8 AND yesterday()
+                                                GROUP BY event_date
+                                                        ),
+
+                        -- Подзапрос 2: считаем медиану по пользователям за каждый день
+                                    medians AS (
+                                                SELECT 
+                                                        event_date,
+                                                        quantile(0.5)(sent_messages) AS median_per_user
+                                                FROM (
+                                                        SELECT 
+                                                            toDate(time) AS event_date,
+                                                            user_id,
+                                                            count(*) AS sent_messages
+                                                        FROM simulator_20250620.message_actions
+                                                        WHERE toDate(time) BETWEEN today() - 8 AND yesterday()
+                                                        GROUP BY event_date, user_id
+                                                        )
+                                                GROUP BY event_date
+                                                )
+
+                        -- Объединяем
+                            SELECT 
+                                m.event_date,
+                                m.messages_sent,
+                                m.dau,
+                                m.avg_per_user,
+                                med.median_per_user
+                            FROM main_stats AS m
+                            JOIN medians AS med ON m.event_date = med.event_date
+                            ORDER BY m.event_date;'''
+
+    df_block_message = outbox_artifact(run_date, run_id, chat_id, 'message/block',
+                                       lambda: read_clickhouse(query=message_information, report='message', name='block'))
 
     # Проверяем данные  # ТУТ ЕСЛИ ПРИДЕТ ПУСТОЙ ДАТАФРЕМ ТО У НАС НЕ СЛОМАЕТСЯ ДАГ А ПРИДЕТ ПРОСТО СООБЩЕНИЕ ЧТО НЕТ ДАННЫХ
     if df_block_message.empty:
-        bot.sendMessage(chat_id=chat_id, text="Нет данных для отчёта.")
+        outbox_send_message(bot, chat_id, run_id, 'message/no_data',
+                            "Нет данных для отчёта.")
         return
 
     # Конвертируем даты
@@ -722,10 +1678,252 @@ def generate_message_information(chat_id):
     message += f'- Медиана: {yesterday_median_per_user} ({format_change(delta_median_per_user)})\n'
     message += f'- Среднее: {yesterday_avg_per_user} ({format_change(delta_avg_per_user)})\n'
 
-    bot.sendMessage(chat_id=chat_id, text=message)
+    outbox_send_message(bot, chat_id, run_id, 'message/message', message)
 
     # Вызов функции где будут строится графики передаем
-    send_plot_message(df_block_message, bot, chat_id)
+    send_plot_message(df_block_message, bot, chat_id, run_date, run_id)
+
+
+# ============================================================================
+# ВОРКЕР РЕНДЕРА
+# ============================================================================
+
+# Отдельный долгоживущий процесс рисует графики по запросам через локальный
+# unix-сокет. Выбор бэкенда, поиск шрифта с кириллицей и сборка шаблонов
+# происходят один раз при старте воркера, а не в каждой задаче Airflow.
+# Если воркер не запущен или не смог нарисовать график, графики рисуются
+# прямо в процессе задачи.
+#
+# Протокол без pickle: запрос - JSON с компоновкой и форматом, затем датафреймы
+# в формате Arrow IPC; ответ - статус и байты картинки (или текст ошибки).
+# Каждая часть передается как 8 байт длины + данные. Сокет лежит в каталоге
+# с правами 0700, обе стороны проверяют, что на другом конце тот же пользователь.
+
+PLOT_DRAW_FUNCS = {
+    'report': draw_plot,
+    'audience': draw_plot_audience,
+    'lenta': draw_plot_lenta,
+    'message': draw_plot_message,
+}
+
+RENDER_FORMATS = ('png', 'svg')
+RENDER_MAX_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def preload_render_resources():
+    # Фиксируем шрифт с кириллицей: если его нет, воркер не стартует
+    matplotlib.rcParams['font.family'] = RENDER_FONT_FAMILY
+    font_manager.findfont(font_manager.FontProperties(family=RENDER_FONT_FAMILY),
+                          fallback_to_default=False)
+
+    # Собираем шаблоны всех компоновок и прогреваем кэши пробным рендером
+    for layout, (draw_func, layout_frames) in make_benchmark_frames().items():
+        render_plot_template(layout, draw_func, layout_frames, use_template=True)
+
+
+def render_socket_private(path):
+    # Каталог сокета должен принадлежать текущему пользователю и быть закрыт
+    # для остальных, иначе чужой процесс может подложить свой сокет
+    directory_stat = os.stat(os.path.dirname(path))
+    return directory_stat.st_uid == os.getuid() and not directory_stat.st_mode & 0o077
+
+
+def render_peer_is_owner(sock):
+    # Пользователь процесса на другом конце сокета (Linux), иначе полагаемся на права каталога
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+
+def write_render_chunk(stream, payload):
+    stream.write(struct.pack('>Q', len(payload)))
+    stream.write(payload)
+
+
+def read_render_chunk(stream):
+    header = stream.read(8)
+    if len(header) < 8:
+        raise ConnectionError('render worker: соединение закрыто')
+    size, = struct.unpack('>Q', header)
+    if size > RENDER_MAX_CHUNK_BYTES:
+        raise ValueError(f'render worker: слишком большое сообщение ({size} байт)')
+    payload = stream.read(size)
+    if len(payload) < size:
+        raise ConnectionError('render worker: соединение закрыто')
+    return payload
+
+
+def frame_to_arrow(df):
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def frame_from_arrow(payload):
+    with pa.ipc.open_stream(payload) as reader:
+        return reader.read_pandas()
+
+
+def write_render_request(stream, layout, frames, fmt):
+    write_render_chunk(stream, json.dumps(
+        {'layout': layout, 'fmt': fmt, 'frames': len(frames)}).encode())
+    for df in frames:
+        write_render_chunk(stream, frame_to_arrow(df))
+    stream.flush()
+
+
+def read_render_request(stream):
+    request = json.loads(read_render_chunk(stream))
+    layout, fmt = request['layout'], request['fmt']
+    if layout not in PLOT_DRAW_FUNCS or fmt not in RENDER_FORMATS:
+        raise ValueError(f'render worker: неизвестный график {layout!r} ({fmt!r})')
+    frames = tuple(frame_from_arrow(read_render_chunk(stream))
+                   for _ in range(int(request['frames'])))
+    return layout, frames, fmt
+
+
+class RenderRequestHandler(socketserver.StreamRequestHandler):
+    # Каждый запрос обрабатывается в своем потоке, шаблон компоновки
+    # защищен своей блокировкой, поэтому разные графики рисуются параллельно
+    def handle(self):
+        if not render_peer_is_owner(self.connection):
+            logging.warning('render worker: отклонено подключение другого пользователя')
+            return
+
+        layout = None
+        try:
+            layout, frames, fmt = read_render_request(self.rfile)
+            plot_object = render_plot_template(layout, PLOT_DRAW_FUNCS[layout], frames,
+                                               use_template=True, fmt=fmt)
+            status, payload = b'ok', plot_object.getvalue()
+        except Exception as e:
+            logging.exception('render worker: ошибка рендера %s', layout)
+            status, payload = b'error', f'{type(e).__name__}: {e}'.encode()
+
+        write_render_chunk(self.wfile, status)
+        write_render_chunk(self.wfile, payload)
+        self.wfile.flush()
+
+
+def run_render_worker():
+    # Каталог сокета создается с правами 0700 до bind, поэтому между созданием
+    # сокета и выставлением прав к нему никто не подключится
+    directory = os.path.dirname(RENDER_WORKER_SOCKET)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not render_socket_private(RENDER_WORKER_SOCKET):
+        raise RuntimeError(
+            f'render worker: каталог {directory} должен принадлежать пользователю воркера и иметь права 0700')
+
+    preload_render_resources()
+
+    if os.path.exists(RENDER_WORKER_SOCKET):
+        os.remove(RENDER_WORKER_SOCKET)
+
+    with socketserver.ThreadingUnixStreamServer(RENDER_WORKER_SOCKET, RenderRequestHandler) as server:
+        os.chmod(RENDER_WORKER_SOCKET, 0o600)
+        logging.info('render worker: слушаем %s', RENDER_WORKER_SOCKET)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(RENDER_WORKER_SOCKET)
+
+
+def render_plot_remote(layout, frames, fmt='png'):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(RENDER_WORKER_TIMEOUT)
+        sock.connect(RENDER_WORKER_SOCKET)
+        if not render_peer_is_owner(sock):
+            raise PermissionError('render worker: сокет принадлежит другому пользователю')
+
+        with sock.makefile('rwb') as stream:
+            write_render_request(stream, layout, frames, fmt)
+            status = read_render_chunk(stream)
+            payload = read_render_chunk(stream)
+
+    if status != b'ok':
+        raise RuntimeError(f'render worker: {payload.decode(errors="replace")}')
+
+    return io.BytesIO(payload)
+
+
+def render_plot(layout, frames, fmt='png'):
+    # Сначала пробуем воркер; если он недоступен, не прошел проверку владельца
+    # или не смог нарисовать график - рисуем в процессе задачи
+    if RENDER_WORKER_SOCKET and os.path.exists(RENDER_WORKER_SOCKET):
+        try:
+            if not render_socket_private(RENDER_WORKER_SOCKET):
+                raise PermissionError(
+                    f'каталог {os.path.dirname(RENDER_WORKER_SOCKET)} доступен другим пользователям')
+            return render_plot_remote(layout, frames, fmt)
+        except Exception as e:
+            logging.warning('render worker недоступен, рисуем локально: %s', e)
+
+    return render_plot_template(layout, PLOT_DRAW_FUNCS[layout], frames, fmt=fmt)
+
+
+def make_benchmark_frames(days=30):
+    # Синтетические данные той же формы, что приходят из ClickHouse
+    rng = np.random.default_rng(0)
+    dates = pd.date_range(end=datetime.now().date() - timedelta(days=1),
+                          periods=days)
+
+    df_report = pd.DataFrame({
+        'date': np.repeat(dates, 2),
+        'source': ['ads', 'organic'] * days,
+    })
+    for column in ['dau', 'likes', 'views', 'sent_messages', 'unique_senders']:
+        df_report[column] = rng.integers(1000, 100000, size=len(df_report))
+
+    weeks = pd.date_range(end=dates[-1], periods=8, freq='W-MON')
+    df_action_audience = pd.DataFrame({
+        'this_week': np.repeat(weeks.strftime('%Y-%m-%d'), 3),
+        'status': ['новые', 'старые', 'ушедшие'] * len(weeks),
+        'users_count': rng.integers(-5000, 20000, size=len(weeks) * 3),
+    })
+
+    df_block = pd.DataFrame({'event_date': dates[-8:].strftime('%Y-%m-%d')})
+    for column in ['dau', 'likes', 'views', 'messages_sent']:
+        df_block[column] = rng.integers(1000, 100000, size=len(df_block))
+    df_block['CTR'] = df_block['likes'] / df_block['views']
+    df_block['avg_per_user'] = df_block['messages_sent'] / df_block['dau']
+    df_block['median_per_user'] = df_block['avg_per_user'].round()
+
+    return {
+        'report': (draw_plot, (df_report, df_report, df_report)),
+        'audience': (draw_plot_audience, (df_action_audience,)),
+        'lenta': (draw_plot_lenta, (df_block,)),
+        'message': (draw_plot_message, (df_block,)),
+    }
+
+
+def benchmark_plot_templates(renders=5):
+    # Сравниваем рендеры в секунду с кэшем шаблонов и без него
+    frames = make_benchmark_frames()
+    results = {}
+
+    for layout, (draw_func, layout_frames) in frames.items():
+        # прогрев: шаблон и шрифты готовы до начала замера
+        render_plot_template(layout, draw_func, layout_frames, use_template=True)
+
+        for use_template in (False, True):
+            started = time.perf_counter()
+            for _ in range(renders):
+                render_plot_template(layout, draw_func, layout_frames,
+                                     use_template=use_template)
+            elapsed = time.perf_counter() - started
+            results[(layout, use_template)] = renders / elapsed
+
+    print(f"{'Компоновка':<12}{'без кэша':>12}{'с кэшем':>12}{'ускорение':>12}")
+    for layout in frames:
+        uncached = results[(layout, False)]
+        cached = results[(layout, True)]
+        print(f"{layout:<12}{uncached:>12.2f}{cached:>12.2f}{cached / uncached:>11.2f}x")
+
+    return results
 
 
 connection = {
@@ -739,6 +1937,56 @@ connection = {
 BOT_TOKEN = 'Ваш токен'
 chat_id = 'Ваш ID чата'
 
+# Режим общих метрик: exact - точный, sampled - выборка пользователей по
+# cityHash64(user_id) % REPORT_SAMPLE_MODULO, sketch - приближенные агрегаты ClickHouse
+REPORT_MODES = ('exact', 'sampled', 'sketch')
+REPORT_MODE = 'exact'
+REPORT_SAMPLE_MODULO = 100
+
+# Быстрый предварительный отчет перед точным (None - не отправлять)
+PREVIEW_REPORT_MODE = 'sampled'
+
+# Переиспользовать шаблоны фигур между рендерами (False - строить фигуру заново)
+USE_PLOT_TEMPLATES = True
+
+# Воркер рендера графиков: сокет (None - всегда рисовать в задаче) в каталоге
+# с правами 0700, таймаут одного рендера в секундах и шрифт с кириллицей
+RENDER_WORKER_SOCKET = os.path.join(os.environ.get('AIRFLOW_HOME', os.path.expanduser('~/airflow')),
+                                    'run', 'telegram_reports_render.sock')
+RENDER_WORKER_TIMEOUT = 120
+RENDER_FONT_FAMILY = 'DejaVu Sans'
+
+# Локальная база очереди доставки: посчитанные результаты и отметки об отправке
+OUTBOX_PATH = 'telegram_reports_outbox.sqlite'
+OUTBOX_KEEP_DAYS = 14
+
+# Хранилище артефактов: датафреймы (parquet), графики (png, svg), тексты и манифест.
+# ARTIFACTS_REUSE - повторная отправка: брать результат за эту дату из хранилища
+# вместо запроса (хранилище не знает о запусках, поэтому по умолчанию выключено)
+EXPORT_ARTIFACTS = True
+ARTIFACTS_DIR = 'report_artifacts'
+ARTIFACTS_SVG = False
+ARTIFACTS_REUSE = False
+
+# Бюджеты запросов: warn - предупреждение в логе, fail - лимиты на стороне
+# ClickHouse и падение задачи. Ключ - 'отчет/запрос', 'default' - для всех остальных
+QUERY_BUDGET_MODE = 'warn'
+QUERY_BUDGETS = {
+    'default': {
+        'read_rows': 2_000_000_000,
+        'read_bytes': 50 * 1024 ** 3,
+        'memory_usage': 10 * 1024 ** 3,
+        'duration_ms': 600_000,
+    },
+}
+QUERY_COSTS_PATH = 'telegram_reports_query_costs.sqlite'
+QUERY_LOG_ATTEMPTS = 3
+QUERY_LOG_WAIT_SECONDS = 5
+
+# Агрегаты в ClickHouse: база с правами на запись и флаг чтения из них
+ROLLUP_DATABASE = 'Ваша база для агрегатов'
+USE_ROLLUPS = True
+
 default_args = {
     'owner': 'aleksej-polozov-bel8894',
     'depends_on_past': False,
@@ -754,30 +2002,68 @@ schedule_interval = '0 11 * * *'
 @dag(dag_id='aleksej_polozov_bel8894_full_report', default_args=default_args, schedule_interval=schedule_interval, catchup=False)
 def dag_report():
 
+    # Каждая задача учитывает стоимость своих запросов (query_cost_tracking)
+
+    @task()
+    def report_preview_task():
+        # Быстрая оценка общих метрик приходит в чат раньше точного отчета.
+        # Ошибка предварительного отчета не должна останавливать точный
+        if PREVIEW_REPORT_MODE is None:
+            return
+        try:
+            context = get_current_context()
+            with query_cost_tracking(context['ds']):
+                generate_basic_information(chat_id, context['ds'], context['run_id'],
+                                           mode=PREVIEW_REPORT_MODE)
+        except Exception:
+            logging.exception('preview: не удалось отправить предварительный отчет')
+
+    @task()
+    def populate_rollups_task():
+        # Ошибка пересчета агрегатов не должна останавливать отчеты:
+        # генераторы увидят несвежие агрегаты и прочитают сырые таблицы
+        try:
+            with query_cost_tracking(get_current_context()['ds']):
+                populate_rollups()
+        except Exception:
+            logging.exception('rollups: не удалось пересчитать агрегаты')
+
     @task()
     def report_text_task():
-        generate_basic_information(chat_id)
+        # run_id запуска не меняется между повторами, поэтому повтор продолжит этот же запуск
+        context = get_current_context()
+        with query_cost_tracking(context['ds']):
+            generate_basic_information(chat_id, context['ds'], context['run_id'])
 
     @task()
     def report_plot_task():
-        generate_report_plot(chat_id)
+        context = get_current_context()
+        with query_cost_tracking(context['ds']):
+            generate_report_plot(chat_id, context['ds'], context['run_id'])
 
     @task()
     def report_text_lenta_task():
-        generate_lenta_information(chat_id)
+        context = get_current_context()
+        with query_cost_tracking(context['ds']):
+            generate_lenta_information(chat_id, context['ds'], context['run_id'])
 
     @task()
     def report_text_message_task():
-        generate_message_information(chat_id)
+        context = get_current_context()
+        with query_cost_tracking(context['ds']):
+            generate_message_information(chat_id, context['ds'], context['run_id'])
 
     # Вызываем таски — создаём зависимости
+    task_preview = report_preview_task()
+    task0 = populate_rollups_task()
     task1 = report_text_task()
     task2 = report_plot_task()
     task3 = report_text_lenta_task()
     task4 = report_text_message_task()
 
-    # порядок выполнения
-    task1 >> task2 >> task3 >> task4
+    # порядок выполнения: предварительный отчет - отдельная ветка без связей
+    # с точным, чтобы не задерживать его на время своих запросов
+    task0 >> task1 >> task2 >> task3 >> task4
 
 
 dag = dag_report()
@@ -791,30 +2077,78 @@ if __name__ == "__main__":
     Ручной запуск системы для тестирования.
     Запустите: python telegram_reports_system.py
     """
+    # Замер скорости рендера графиков: python telegram_reports_system.py --benchmark-plots
+    if '--benchmark-plots' in sys.argv:
+        print("⏱ Замер скорости рендера графиков (рендеров в секунду)...")
+        benchmark_plot_templates()
+        sys.exit(0)
+
+    # Воркер рендера графиков: python telegram_reports_system.py --render-worker
+    if '--render-worker' in sys.argv:
+        print("🖼 Запуск воркера рендера графиков...")
+        logging.basicConfig(level=logging.INFO)
+        run_render_worker()
+        sys.exit(0)
+
+    # Стоимость запросов запуска в сравнении с предыдущим:
+    # python telegram_reports_system.py --query-costs [2025-07-18]
+    if '--query-costs' in sys.argv:
+        dates = sys.argv[sys.argv.index('--query-costs') + 1:]
+        print(format_query_cost_report(dates[0] if dates else None))
+        sys.exit(0)
+
+    # Пересчет агрегатов и бэкфилл (по умолчанию - все непосчитанные дни до вчера):
+    # python telegram_reports_system.py --populate-rollups [2025-06-20] [2025-07-18]
+    if '--populate-rollups' in sys.argv:
+        dates = sys.argv[sys.argv.index('--populate-rollups') + 1:]
+        print("🧮 Пересчет агрегатов в ClickHouse...")
+        populate_rollups(dates[0] if len(dates) > 0 else None,
+                         dates[1] if len(dates) > 1 else None)
+        sys.exit(0)
+
+    # Продолжить упавший ручной запуск без повторной отправки:
+    # python telegram_reports_system.py --run-id manual__2025-07-19T10:00:00
+    if '--run-id' in sys.argv:
+        OUTBOX_MANUAL_RUN_ID = sys.argv[sys.argv.index('--run-id') + 1]
+
+    # Повторная отправка отчета за дату планового запуска (ds) по данным из
+    # хранилища артефактов, без запросов в ClickHouse:
+    # python telegram_reports_system.py --run-date 2025-07-18 --reuse-artifacts
+    run_date = None
+    if '--run-date' in sys.argv:
+        run_date = sys.argv[sys.argv.index('--run-date') + 1]
+    if '--reuse-artifacts' in sys.argv:
+        ARTIFACTS_REUSE = True
+
     print("🚀 Запуск системы автоматических отчетов...")
 
     try:
-        # 1. Генерация базового отчета
-        print("📊 Генерация базового отчета...")
-        generate_basic_information(chat_id)
+        with query_cost_tracking(run_date):
+            # 1. Генерация базового отчета (сначала быстрая оценка, затем точный)
+            print("📊 Генерация базового отчета...")
+            if PREVIEW_REPORT_MODE is not None:
+                generate_basic_information(chat_id, run_date, mode=PREVIEW_REPORT_MODE)
+            generate_basic_information(chat_id, run_date)
 
-        # 2. Создание графиков
-        print("📈 Создание графиков...")
-        generate_report_plot(chat_id)
+            # 2. Создание графиков
+            print("📈 Создание графиков...")
+            generate_report_plot(chat_id, run_date)
 
-        # 3. Отчет по ленте новостей
-        print("📰 Отчет по ленте новостей...")
-        generate_lenta_information(chat_id)
+            # 3. Отчет по ленте новостей
+            print("📰 Отчет по ленте новостей...")
+            generate_lenta_information(chat_id, run_date)
 
-        # 4. Отчет по мессенджеру
-        print("💬 Отчет по мессенджеру...")
-        generate_message_information(chat_id)
+            # 4. Отчет по мессенджеру
+            print("💬 Отчет по мессенджеру...")
+            generate_message_information(chat_id, run_date)
 
         print("✅ Все отчеты успешно отправлены!")
+        print(format_query_cost_report(run_date))
 
     except Exception as e:
         print(f"❌ Ошибка при выполнении: {e}")
+        print(f"🔁 Продолжить запуск без повторной отправки: --run-id {OUTBOX_MANUAL_RUN_ID}")
         print("💡 Убедитесь, что:")
-        print("   - Установлены все зависимости: pip install apache-airflow pandas numpy matplotlib seaborn pandahouse python-telegram-bot requests")
+        print("   - Установлены все зависимости: pip install apache-airflow pandas numpy pyarrow matplotlib seaborn pandahouse python-telegram-bot requests")
         print("   - Настроены переменные окружения (BOT_TOKEN, CHAT_ID, CLICKHOUSE_*)")
         print("   - Бот добавлен в чат и имеет права на отправку сообщений")
@@ -0,0 +1,133 @@
+"""
+Хранилище артефактов: датафреймы общих метрик и векторная копия графиков.
+"""
+
+import hashlib
+import io
+import os
+
+import pandas as pd
+import pytest
+
+reports = pytest.importorskip('telegram_reports_system')
+
+BASIC_FRAMES = ['users', 'source_counts', 'median_like_view', 'median_message']
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(reports, 'OUTBOX_PATH', str(tmp_path / 'outbox.sqlite'))
+    monkeypatch.setattr(reports, 'ARTIFACTS_DIR', str(tmp_path / 'artifacts'))
+    return tmp_path / 'artifacts'
+
+
+@pytest.fixture
+def basic_queries(monkeypatch):
+    frames = {
+        'total_users': pd.DataFrame({'users': [300]}),
+        'doly_organic_ads': pd.DataFrame({'user_id': [1, 2, 3, 4], 'source': ['ads', 'ads', 'organic', 'organic']}),
+        'average_user_like_view': pd.DataFrame({'user': [1, 2, 3], 'source': ['ads', 'organic', 'organic'],
+                                                'likes': [2, 4, 6], 'views': [10, 20, 30]}),
+        'average_sent_message_view': pd.DataFrame({'user': [1, 2, 3], 'source': ['ads', 'organic', 'organic'],
+                                                   'sent_messages': [3, 5, 7]}),
+    }
+    executed = []
+
+    def read_clickhouse(query, report, name):
+        executed.append(name)
+        return frames[name].copy()
+
+    monkeypatch.setattr(reports, 'read_clickhouse', read_clickhouse)
+    return executed
+
+
+class Bot:
+    def __init__(self, events):
+        self.events = events
+
+    def sendMessage(self, chat_id, text):
+        self.events.append('message')
+
+    def sendPhoto(self, chat_id, photo):
+        self.events.append('photo')
+
+
+def test_basic_frames_are_exported(store, basic_queries, monkeypatch):
+    monkeypatch.setattr(reports.telegram, 'Bot', lambda token=None: Bot([]))
+
+    reports.generate_basic_information(1, '2025-07-18', 'run-1', mode='exact')
+    reports.generate_basic_information(1, '2025-07-18', 'run-1', mode='sampled')
+
+    for name in BASIC_FRAMES:
+        assert (store / 'report=basic' / 'date=2025-07-18' / f'{name}.parquet').exists(), name
+        assert (store / 'report=basic' / 'date=2025-07-18' / f'preview_sampled_{name}.parquet').exists(), name
+
+    median_like_view = reports.read_report_frame('basic', 'median_like_view', '2025-07-18')
+    assert list(median_like_view['source']) == ['ads', 'organic']
+    assert list(median_like_view['likes']) == [2, 5]
+
+    # Повтор части отчета берет датафреймы из outbox без запросов
+    basic_queries.clear()
+    reports.build_basic_information(1, '2025-07-18', 'run-1', mode='exact')
+    assert basic_queries == []
+
+
+def test_svg_is_rendered_after_photo_delivery(store, monkeypatch):
+    monkeypatch.setattr(reports, 'ARTIFACTS_SVG', True)
+    events = []
+
+    def build(fmt='png'):
+        events.append(fmt)
+        return io.BytesIO(b'<svg/>' if fmt == 'svg' else b'png')
+
+    bot = Bot(events)
+    reports.outbox_send_photo(bot, 1, '2025-07-18', 'run-1', 'report/plot', build, 'plot.png')
+    assert events == ['png', 'photo', 'svg']
+    assert os.path.exists(reports.artifact_path('2025-07-18', 'report/plot', 'svg'))
+
+    # Уже доставленный график не рендерится повторно ни в одном формате
+    events.clear()
+    reports.outbox_send_photo(bot, 1, '2025-07-18', 'run-1', 'report/plot', build, 'plot.png')
+    assert events == []
+
+
+def test_svg_is_off_by_default(store):
+    events = []
+
+    def build(fmt='png'):
+        events.append(fmt)
+        return io.BytesIO(b'png')
+
+    reports.outbox_send_photo(Bot(events), 1, '2025-07-18', 'run-1', 'report/plot', build, 'plot.png')
+    assert events == ['png', 'photo']
+
+
+def test_rebuilt_value_overwrites_store(store):
+    reports.outbox_artifact('2025-07-18', 'manual__1', 1, 'lenta/block',
+                            lambda: pd.DataFrame({'dau': [1]}))
+    reports.outbox_artifact('2025-07-18', 'scheduled__1', 1, 'lenta/block',
+                            lambda: pd.DataFrame({'dau': [2]}))
+
+    # В хранилище и манифесте - значение последнего запуска
+    assert list(reports.read_report_frame('lenta', 'block', '2025-07-18')['dau']) == [2]
+    entry = reports.read_report_manifest('lenta', '2025-07-18')['files']['block.parquet']
+    assert entry['run_id'] == 'scheduled__1'
+    with open(reports.artifact_path('2025-07-18', 'lenta/block', 'parquet'), 'rb') as f:
+        assert entry['sha256'] == hashlib.sha256(f.read()).hexdigest()
+
+
+def test_reuse_is_opt_in(store, monkeypatch):
+    reports.outbox_artifact('2025-07-18', 'manual__1', 1, 'lenta/block',
+                            lambda: pd.DataFrame({'dau': [1]}))
+
+    # По умолчанию другой запуск с тем же ds считает заново
+    built = []
+    reports.outbox_artifact('2025-07-18', 'scheduled__1', 1, 'lenta/block',
+                            lambda: built.append(1) or pd.DataFrame({'dau': [2]}))
+    assert built == [1]
+
+    # Повторная отправка из хранилища - только по явному флагу
+    monkeypatch.setattr(reports, 'ARTIFACTS_REUSE', True)
+    value = reports.outbox_artifact('2025-07-18', 'resend__1', 1, 'lenta/block',
+                                    lambda: pytest.fail('запрос при повторной отправке'))
+    assert list(value['dau']) == [2]
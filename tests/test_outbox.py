@@ -0,0 +1,87 @@
+"""
+Outbox: повтор задачи продолжает запуск без повторных запросов и отправок.
+"""
+
+import io
+
+import pandas as pd
+import pytest
+
+reports = pytest.importorskip('telegram_reports_system')
+
+DATES = pd.to_datetime(['2025-07-16', '2025-07-16', '2025-07-17', '2025-07-17'])
+SOURCES = ['ads', 'organic', 'ads', 'organic']
+
+REPORT_FRAMES = {
+    'dau_source': pd.DataFrame({'date': DATES, 'source': SOURCES, 'dau': [10, 20, 11, 21]}),
+    'like_views_source': pd.DataFrame({'date': DATES, 'source': SOURCES,
+                                       'likes': [1, 2, 3, 4], 'views': [10, 20, 30, 40]}),
+    'sent_message': pd.DataFrame({'date': DATES, 'source': SOURCES,
+                                  'sent_messages': [5, 6, 7, 8], 'unique_senders': [2, 3, 4, 5]}),
+    'action_audience': pd.DataFrame({'this_week': pd.to_datetime(['2025-07-14'] * 3),
+                                     'previous_week': pd.to_datetime(['2025-07-07'] * 3),
+                                     'status': ['новые', 'старые', 'ушедшие'],
+                                     'users_count': [5, 7, -3]}),
+}
+
+
+class Bot:
+    def __init__(self, fail_on=None):
+        self.sent = []
+        self.fail_on = fail_on
+
+    def sendMessage(self, chat_id, text):
+        self.sent.append(text)
+
+    def sendPhoto(self, chat_id, photo):
+        if photo.name == self.fail_on:
+            raise ConnectionError('Telegram недоступен')
+        self.sent.append(photo.name)
+
+
+@pytest.fixture
+def report_run(tmp_path, monkeypatch):
+    executed = []
+
+    def read_clickhouse(query, report, name):
+        executed.append(name)
+        return REPORT_FRAMES[name].copy()
+
+    monkeypatch.setattr(reports, 'read_clickhouse', read_clickhouse)
+    monkeypatch.setattr(reports, 'rollups_fresh', lambda start=None: False)
+    monkeypatch.setattr(reports, 'render_plot',
+                        lambda layout, frames, fmt='png': io.BytesIO(layout.encode()))
+    monkeypatch.setattr(reports, 'OUTBOX_PATH', str(tmp_path / 'outbox.sqlite'))
+    monkeypatch.setattr(reports, 'ARTIFACTS_DIR', str(tmp_path / 'artifacts'))
+    return executed
+
+
+def test_retry_resumes_after_failed_photo(report_run, monkeypatch):
+    bot = Bot(fail_on='full_report_audience.png')
+    monkeypatch.setattr(reports.telegram, 'Bot', lambda token=None: bot)
+
+    with pytest.raises(ConnectionError):
+        reports.generate_report_plot(1, '2025-07-18', 'scheduled__2025-07-18T11:00:00+00:00')
+    assert sorted(report_run) == sorted(REPORT_FRAMES)
+    assert bot.sent == ['📊 Графики метрик', 'full_report_5_graphs.png',
+                        '📊 График активная аудитория по неделям']
+
+    # Повтор той же задачи: запросы не выполняются, отправляется только недошедшее
+    report_run.clear()
+    bot.sent.clear()
+    bot.fail_on = None
+    reports.generate_report_plot(1, '2025-07-18', 'scheduled__2025-07-18T11:00:00+00:00')
+    assert report_run == []
+    assert bot.sent == ['full_report_audience.png']
+
+
+def test_runs_with_same_ds_are_independent(report_run, monkeypatch):
+    bot = Bot()
+    monkeypatch.setattr(reports.telegram, 'Bot', lambda token=None: bot)
+
+    # Ручной запуск и плановый запуск с тем же ds - разные запуски
+    reports.generate_report_plot(1, '2025-07-18', 'manual__2025-07-18T15:00:00+00:00')
+    reports.generate_report_plot(1, '2025-07-18', 'scheduled__2025-07-18T11:00:00+00:00')
+
+    assert len(report_run) == 2 * len(REPORT_FRAMES)
+    assert bot.sent.count('full_report_audience.png') == 2
@@ -0,0 +1,138 @@
+"""
+Учет запросов: query_id и лимиты в адресе, запись упавших запросов,
+сверка с бюджетами на синтетической статистике и сравнение запусков.
+"""
+
+import sqlite3
+import types
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import pytest
+
+reports = pytest.importorskip('telegram_reports_system')
+
+
+@pytest.fixture
+def hosts(monkeypatch):
+    requested = []
+
+    def read_clickhouse(query, connection):
+        requested.append(parse_qs(urlsplit(connection['host']).query))
+        if 'fail' in query:
+            raise RuntimeError('TOO_MANY_ROWS')
+        return pd.DataFrame({'x': [1]})
+
+    def execute(query, connection):
+        requested.append(parse_qs(urlsplit(connection['host']).query))
+
+    monkeypatch.setattr(reports, 'ph', types.SimpleNamespace(read_clickhouse=read_clickhouse,
+                                                             execute=execute))
+    monkeypatch.setattr(reports, 'QUERY_RUN_LOG', [])
+    return requested
+
+
+@pytest.fixture
+def costs(hosts, tmp_path, monkeypatch):
+    path = tmp_path / 'costs.sqlite'
+    monkeypatch.setattr(reports, 'QUERY_COSTS_PATH', str(path))
+    monkeypatch.setattr(reports, 'QUERY_BUDGETS', {
+        'default': {'read_rows': 1000, 'read_bytes': 10 ** 6,
+                    'memory_usage': 10 ** 6, 'duration_ms': 1000},
+        'report/dau_source': {'read_rows': 100},
+    })
+    return path
+
+
+def synthetic_stats(read_rows):
+    # fetch_stats: query_log заменен синтетикой, read_rows по имени запроса из query_id
+    def fetch_stats(query_ids):
+        return pd.DataFrame([{'query_id': query_id,
+                              'read_rows': read_rows[query_id.split('-')[2]],
+                              'read_bytes': 1000, 'memory_usage': 2000, 'duration_ms': 10.0}
+                             for query_id in query_ids])
+    return fetch_stats
+
+
+def run_report_queries(run_date, read_rows):
+    with reports.query_cost_tracking(run_date, synthetic_stats(read_rows)):
+        reports.read_clickhouse('SELECT 1', report='report', name='dau_source')
+        reports.read_clickhouse('SELECT 1', report='lenta', name='block')
+
+
+def test_failed_query_is_recorded(hosts):
+    reports.read_clickhouse('SELECT 1', report='basic', name='ok')
+    with pytest.raises(RuntimeError):
+        reports.read_clickhouse('SELECT fail', report='basic', name='broken')
+
+    assert [row['name'] for row in reports.QUERY_RUN_LOG] == ['ok', 'broken']
+    assert [row['query_id'] for row in reports.QUERY_RUN_LOG] == \
+        [params['query_id'][0] for params in hosts]
+
+
+def test_subsecond_duration_budget_is_not_unlimited(hosts, monkeypatch):
+    monkeypatch.setattr(reports, 'QUERY_BUDGET_MODE', 'fail')
+    monkeypatch.setattr(reports, 'QUERY_BUDGETS', {
+        'default': dict(reports.QUERY_BUDGETS['default'], duration_ms=500),
+        'basic/slow': {'duration_ms': 2500},
+    })
+
+    reports.read_clickhouse('SELECT 1', report='basic', name='fast')
+    reports.read_clickhouse('SELECT 1', report='basic', name='slow')
+
+    assert [params['max_execution_time'] for params in hosts] == [['1'], ['3']]
+
+
+def test_execute_is_tagged_and_recorded(hosts):
+    reports.execute_clickhouse('INSERT INTO t SELECT 1', report='rollups', name='daily_feed')
+
+    assert hosts[0]['query_id'][0].startswith('tgreports-rollups-daily_feed-')
+    assert [row['name'] for row in reports.QUERY_RUN_LOG] == ['daily_feed']
+
+
+def test_warn_mode_logs_violation_and_persists_costs(costs, caplog):
+    run_report_queries('2025-07-18', {'dau_source': 150, 'block': 50})
+
+    violations = [record.getMessage() for record in caplog.records
+                  if 'превышен бюджет' in record.getMessage()]
+    assert violations == ['query costs: превышен бюджет report/dau_source: read_rows = 150 > 100']
+
+    with sqlite3.connect(costs) as db:
+        rows = db.execute('SELECT run_date, report, name, read_rows, read_bytes, memory_usage, duration_ms '
+                          'FROM query_costs ORDER BY report').fetchall()
+    assert rows == [('2025-07-18', 'lenta', 'block', 50, 1000, 2000, 10.0),
+                    ('2025-07-18', 'report', 'dau_source', 150, 1000, 2000, 10.0)]
+
+
+def test_fail_mode_fails_without_retry(costs, monkeypatch):
+    monkeypatch.setattr(reports, 'QUERY_BUDGET_MODE', 'fail')
+
+    with pytest.raises(reports.AirflowFailException, match='dau_source: read_rows = 150 > 100'):
+        run_report_queries('2025-07-18', {'dau_source': 150, 'block': 50})
+
+    # Стоимость сохраняется и при падении
+    with sqlite3.connect(costs) as db:
+        assert db.execute('SELECT count(*) FROM query_costs').fetchone() == (2,)
+
+
+def test_fail_mode_keeps_original_error(costs, monkeypatch):
+    monkeypatch.setattr(reports, 'QUERY_BUDGET_MODE', 'fail')
+
+    with pytest.raises(RuntimeError, match='TOO_MANY_ROWS'):
+        with reports.query_cost_tracking('2025-07-18', synthetic_stats({'dau_source': 150, 'broken': 0})):
+            reports.read_clickhouse('SELECT 1', report='report', name='dau_source')
+            reports.read_clickhouse('SELECT fail', report='report', name='broken')
+
+
+def test_cost_report_compares_with_previous_run(costs):
+    run_report_queries('2025-07-17', {'dau_source': 80, 'block': 40})
+    run_report_queries('2025-07-18', {'dau_source': 120, 'block': 30})
+
+    report = reports.format_query_cost_report('2025-07-18')
+    assert report.startswith('Стоимость запросов за 2025-07-18 (в скобках - изменение к 2025-07-17)')
+    assert '- report/dau_source: read_rows=120 (+50%), read_bytes=1,000 (+0%)' in report
+    assert '- lenta/block: read_rows=30 (-25%)' in report
+
+    first = reports.format_query_cost_report('2025-07-17')
+    assert first.splitlines()[0] == 'Стоимость запросов за 2025-07-17'
+    assert '(+' not in first
@@ -0,0 +1,77 @@
+"""
+Воркер рендера: протокол без pickle, закрытый каталог сокета, рендер в задаче при ошибках воркера.
+"""
+
+import io
+import os
+import socketserver
+import threading
+
+import pandas as pd
+import pytest
+
+reports = pytest.importorskip('telegram_reports_system')
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    directory = tmp_path / 'run'
+    directory.mkdir(mode=0o700)
+    path = str(directory / 'render.sock')
+    monkeypatch.setattr(reports, 'RENDER_WORKER_SOCKET', path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, reports.RenderRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_frames_survive_arrow_round_trip():
+    frames = reports.make_benchmark_frames(days=5)
+    for _, layout_frames in frames.values():
+        for df in layout_frames:
+            pd.testing.assert_frame_equal(reports.frame_from_arrow(reports.frame_to_arrow(df)), df)
+
+
+def test_worker_renders_chart(worker):
+    _, frames = reports.make_benchmark_frames(days=5)['lenta']
+    plot_object = reports.render_plot_remote('lenta', frames)
+    assert plot_object.getvalue().startswith(b'\x89PNG')
+
+
+def test_worker_error_falls_back_to_local_render(worker, monkeypatch):
+    _, frames = reports.make_benchmark_frames(days=5)['lenta']
+    with pytest.raises(RuntimeError, match='render worker'):
+        reports.render_plot_remote('lenta', (frames[0].drop(columns='CTR'),))
+
+    local = []
+    monkeypatch.setattr(reports, 'render_plot_template',
+                        lambda layout, draw_func, frames, fmt='png': local.append(layout) or io.BytesIO(b'local'))
+    assert reports.render_plot('lenta', (frames[0].drop(columns='CTR'),)).getvalue() == b'local'
+    assert local == ['lenta']
+
+
+def test_socket_in_shared_directory_is_not_used(worker, monkeypatch):
+    os.chmod(os.path.dirname(worker), 0o777)
+
+    def remote(layout, frames, fmt='png'):
+        raise AssertionError('подключение к сокету в общем каталоге')
+
+    monkeypatch.setattr(reports, 'render_plot_remote', remote)
+    monkeypatch.setattr(reports, 'render_plot_template',
+                        lambda layout, draw_func, frames, fmt='png': io.BytesIO(b'local'))
+    assert reports.render_plot('lenta', ()).getvalue() == b'local'
+
+
+def test_worker_refuses_shared_directory(tmp_path, monkeypatch):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    os.chmod(directory, 0o777)
+    monkeypatch.setattr(reports, 'RENDER_WORKER_SOCKET', str(directory / 'render.sock'))
+    monkeypatch.setattr(reports, 'preload_render_resources', lambda: None)
+
+    with pytest.raises(RuntimeError, match='0700'):
+        reports.run_render_worker()
+    assert not os.path.exists(directory / 'render.sock')
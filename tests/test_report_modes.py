@@ -0,0 +1,98 @@
+"""
+Режимы общих метрик: масштабирование выборки, скетчи и оценка погрешности.
+"""
+
+import pandas as pd
+import pytest
+
+reports = pytest.importorskip('telegram_reports_system')
+
+SAMPLED_FRAMES = {
+    'total_users': pd.DataFrame({'users': [400]}),
+    'doly_organic_ads': pd.DataFrame({'user_id': range(400),
+                                      'source': ['ads'] * 100 + ['organic'] * 300}),
+    'average_user_like_view': pd.DataFrame({'user': [1, 2, 3], 'source': ['ads', 'organic', 'organic'],
+                                            'likes': [2, 4, 6], 'views': [10, 20, 30]}),
+    'average_sent_message_view': pd.DataFrame({'user': [1, 2, 3], 'source': ['ads', 'organic', 'organic'],
+                                               'sent_messages': [3, 5, 7]}),
+}
+
+SKETCH_FRAMES = {
+    'total_users': pd.DataFrame({'users': [12345]}),
+    'doly_organic_ads': pd.DataFrame({'source': ['ads', 'organic'], 'user_count': [3000, 9000]}),
+    'median_like_view': pd.DataFrame({'source': ['ads', 'organic'], 'likes': [2.4, 5.1], 'views': [10.2, 25.0]}),
+    'median_message': pd.DataFrame({'source': ['ads', 'organic'], 'sent_messages': [3.2, 6.0]}),
+}
+
+
+@pytest.fixture
+def basic_queries(tmp_path, monkeypatch):
+    monkeypatch.setattr(reports, 'OUTBOX_PATH', str(tmp_path / 'outbox.sqlite'))
+    monkeypatch.setattr(reports, 'ARTIFACTS_DIR', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(reports, 'REPORT_SAMPLE_MODULO', 100)
+    executed = []
+
+    def stub(frames):
+        def read_clickhouse(query, report, name):
+            executed.append((report, name, query))
+            return frames[name].copy()
+        monkeypatch.setattr(reports, 'read_clickhouse', read_clickhouse)
+
+    return executed, stub
+
+
+def test_sampled_counts_are_scaled(basic_queries):
+    executed, stub = basic_queries
+    stub(SAMPLED_FRAMES)
+
+    message = reports.build_basic_information(1, '2025-07-18', 'run-1', mode='sampled')
+
+    assert {report for report, _, _ in executed} == {'basic_sampled'}
+    assert all('cityHash64(user_id) % 100 = 0' in query for _, _, query in executed)
+
+    # 400 пользователей в выборке 1% -> 40000
+    assert '- Количество уникальных пользователей: 40000\n' in message
+    assert '- Доля рекламных пользователей:  25.0%\n' in message
+    assert '⚡ Предварительный отчет по выборке 1% пользователей (cityHash64(user_id)).\n' in message
+    # 1.96 * sqrt(0.99 / 400) и 1.96 * sqrt(0.25 * 0.75 / 400)
+    assert 'количество пользователей ±9.75%, доли ±4.24 п.п.' in message
+    assert message.endswith('Точный отчет придет следом.')
+
+
+def test_sketch_uses_server_side_estimates(basic_queries):
+    executed, stub = basic_queries
+    stub(SKETCH_FRAMES)
+
+    message = reports.build_basic_information(1, '2025-07-18', 'run-1', mode='sketch')
+
+    queries = {name: query for _, name, query in executed}
+    assert set(queries) == set(SKETCH_FRAMES)
+    assert 'uniqCombined(user_id)' in queries['total_users']
+    assert 'uniqCombined(user_id)' in queries['doly_organic_ads']
+    assert 'quantileTDigest(0.5)(likes)' in queries['median_like_view']
+    assert 'quantileTDigest(0.5)(sent_messages)' in queries['median_message']
+    assert not any('cityHash64' in query for query in queries.values())
+
+    assert '- Количество уникальных пользователей: 12345\n' in message
+    assert '- Доля рекламных пользователей:  25.0%\n' in message
+    assert 'Лайки на пользователя (медиана):\n- Платный трафик:  2\n' in message
+    assert 'Сообщения на пользователя (медиана):\n- Платный трафик:  3\n' in message
+    # 1.96 * 1.04 / sqrt(2^17)
+    assert 'количество пользователей и доли ±0.56%' in message
+
+
+def test_exact_report_has_no_estimate_note(basic_queries):
+    executed, stub = basic_queries
+    stub(SAMPLED_FRAMES)
+
+    message = reports.build_basic_information(1, '2025-07-18', 'run-1', mode='exact')
+
+    assert '- Количество уникальных пользователей: 400\n' in message
+    assert 'Погрешность' not in message
+    assert not any('cityHash64' in query for _, _, query in executed)
+
+
+def test_preview_is_parallel_branch():
+    preview = reports.dag.get_task('report_preview_task')
+    assert preview.upstream_task_ids == set()
+    assert preview.downstream_task_ids == set()
@@ -0,0 +1,220 @@
+"""
+Агрегаты (rollups) против сырых таблиц на встроенном ClickHouse (chdb).
+
+Запросы отчетов идут в chdb вместо сервера ClickHouse, сырые таблицы
+simulator_20250620 заполняются синтетикой за 40 дней до вчерашнего.
+"""
+
+import io
+import types
+
+import pandas as pd
+import pytest
+
+chdb_session = pytest.importorskip('chdb.session')
+reports = pytest.importorskip('telegram_reports_system')
+
+DAYS = 40
+FRAME_PARTS = ['report/dau_source', 'report/like_views_source', 'report/sent_message',
+               'report/action_audience', 'lenta/block', 'message/block']
+
+
+@pytest.fixture(scope='module')
+def clickhouse(tmp_path_factory):
+    session = chdb_session.Session(str(tmp_path_factory.mktemp('chdb')))
+    session.query('CREATE DATABASE simulator_20250620')
+    session.query('''CREATE TABLE simulator_20250620.feed_actions (
+                         user_id UInt32, time DateTime, action String, source String)
+                     ENGINE = MergeTree ORDER BY time''')
+    session.query('''CREATE TABLE simulator_20250620.message_actions (
+                         user_id UInt32, time DateTime, source String)
+                     ENGINE = MergeTree ORDER BY time''')
+    session.query(f'''INSERT INTO simulator_20250620.feed_actions
+                      SELECT rand() % 3000 AS user_id,
+                             toDateTime(today() - {DAYS}) + rand(1) % (86400 * {DAYS}),
+                             if(rand(2) % 5 = 0, 'like', 'view'),
+                             if(user_id % 3 = 0, 'ads', 'organic')
+                      FROM numbers(300000)''')
+    session.query(f'''INSERT INTO simulator_20250620.message_actions
+                      SELECT rand() % 2000 AS user_id,
+                             toDateTime(today() - {DAYS}) + rand(1) % (86400 * {DAYS}),
+                             if(user_id % 3 = 0, 'ads', 'organic')
+                      FROM numbers(100000)''')
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def queries(clickhouse, tmp_path, monkeypatch):
+    clickhouse.query('DROP DATABASE IF EXISTS rollups')
+    clickhouse.query('CREATE DATABASE rollups')
+
+    executed = []
+
+    def read_clickhouse(query, connection=None):
+        executed.append(query)
+        return clickhouse.query(query, 'DataFrame')
+
+    def execute(query, connection=None):
+        executed.append(query)
+        clickhouse.query(query)
+
+    class Bot:
+        def __init__(self, token=None):
+            pass
+
+        def sendMessage(self, chat_id, text):
+            pass
+
+        def sendPhoto(self, chat_id, photo):
+            pass
+
+    monkeypatch.setattr(reports, 'ph', types.SimpleNamespace(
+        read_clickhouse=read_clickhouse, execute=execute))
+    monkeypatch.setattr(reports.telegram, 'Bot', Bot)
+    monkeypatch.setattr(reports, 'render_plot',
+                        lambda layout, frames, fmt='png': io.BytesIO(b'png'))
+    monkeypatch.setattr(reports, 'ROLLUP_DATABASE', 'rollups')
+    monkeypatch.setattr(reports, 'OUTBOX_PATH', str(tmp_path / 'outbox.sqlite'))
+    monkeypatch.setattr(reports, 'QUERY_COSTS_PATH', str(tmp_path / 'costs.sqlite'))
+    monkeypatch.setattr(reports, 'ARTIFACTS_DIR', str(tmp_path / 'artifacts'))
+    return executed
+
+
+def day(days_ago):
+    return (pd.Timestamp.now().normalize() - pd.Timedelta(days=days_ago)).strftime('%Y-%m-%d')
+
+
+def run_reports(run_id):
+    run_date = day(1)
+    reports.generate_report_plot(1, run_date, run_id)
+    reports.generate_lenta_information(1, run_date, run_id)
+    reports.generate_message_information(1, run_date, run_id)
+
+    def stored(part):
+        raise AssertionError(f'{part} не сохранен в outbox')
+
+    return {part: reports.outbox_artifact(run_date, run_id, 1, part, lambda: stored(part))
+            for part in FRAME_PARTS}
+
+
+def normalized(df):
+    df = df.reset_index(drop=True).copy()
+    for column in df.columns:
+        if 'date' in column or 'week' in column:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def test_rollup_frames_match_raw(queries):
+    raw = run_reports('raw')
+    assert not any('rollups.report_daily_source' in query for query in queries)
+
+    reports.populate_rollups()
+    assert reports.rollups_fresh()
+    assert reports.rollups_fresh('today() - 8')
+
+    queries.clear()
+    rollup = run_reports('rollup')
+    assert sum('rollups.report_daily_source' in query for query in queries) == 5
+    assert sum('rollups.report_weekly_user_activity' in query for query in queries) == 1
+
+    for part in FRAME_PARTS:
+        assert len(raw[part]) > 1, part
+        pd.testing.assert_frame_equal(normalized(raw[part]), normalized(rollup[part]),
+                                      check_dtype=False, rtol=1e-6, obj=part)
+
+
+def test_populate_same_day_twice_does_not_double_count(queries, clickhouse):
+    totals = '''SELECT date, platform,
+                       uniqExactMerge(users) AS users,
+                       sum(views) AS views,
+                       sum(likes) AS likes,
+                       sum(messages) AS messages
+                FROM rollups.report_daily_source
+                GROUP BY date, platform
+                ORDER BY date, platform'''
+
+    reports.populate_rollups()
+    before = clickhouse.query(totals, 'DataFrame')
+
+    reports.populate_rollups(day(1), day(1))
+    reports.populate_rollups(day(5), day(3))
+    after = clickhouse.query(totals, 'DataFrame')
+
+    pd.testing.assert_frame_equal(before, after)
+
+
+def test_rollups_not_fresh_with_gaps(queries):
+    # Посчитан только вчерашний день
+    reports.populate_rollups(day(1), day(1))
+    assert not reports.rollups_fresh()
+    assert not reports.rollups_fresh('today() - 8')
+
+    # Отчеты читают сырые таблицы и получают полное окно
+    queries.clear()
+    frames = run_reports('gaps')
+    assert not any('rollups.report_daily_source' in query for query in queries)
+    assert len(frames['lenta/block']) == 8
+    assert len(frames['report/dau_source']) == 2 * DAYS
+
+
+def test_rollups_not_fresh_with_missing_day_in_window(queries):
+    reports.populate_rollups(day(DAYS), day(4))
+    reports.populate_rollups(day(2), day(1))
+    assert not reports.rollups_fresh()
+    assert not reports.rollups_fresh('today() - 8')
+
+
+def test_populate_fills_days_after_last_populated(queries):
+    # Пересчет упал на несколько дней, следующий запуск по умолчанию их досчитывает
+    reports.populate_rollups(day(DAYS), day(4))
+    assert not reports.rollups_fresh('today() - 8')
+
+    reports.populate_rollups()
+    assert reports.rollups_fresh()
+    assert reports.rollups_fresh('today() - 8')
+
+
+def test_failed_recompute_leaves_day_unlogged(queries, monkeypatch):
+    reports.populate_rollups()
+    execute = reports.ph.execute
+
+    def failing_execute(query, connection=None):
+        if 'simulator_20250620.message_actions' in query:
+            raise RuntimeError('MEMORY_LIMIT_EXCEEDED')
+        execute(query, connection)
+
+    # Данные дня уже удалены, вставка упала: день не должен считаться посчитанным
+    monkeypatch.setattr(reports.ph, 'execute', failing_execute)
+    with pytest.raises(RuntimeError):
+        reports.populate_rollups(day(3), day(3))
+    assert not reports.rollups_fresh()
+    assert not reports.rollups_fresh('today() - 8')
+
+    # Следующий запуск по умолчанию досчитывает только пропущенный день
+    monkeypatch.setattr(reports.ph, 'execute', execute)
+    queries.clear()
+    reports.populate_rollups()
+    assert sum('DELETE WHERE date' in query for query in queries) == 2
+    assert reports.rollups_fresh()
+
+
+def test_recompute_replaces_weekly_pairs(queries, clickhouse):
+    week_pairs = f'''SELECT count() AS pairs
+                     FROM rollups.report_weekly_user_activity
+                     WHERE user_id = 999999 AND week = toMonday(toDate('{day(10)}'))'''
+
+    clickhouse.query(f'''INSERT INTO simulator_20250620.feed_actions
+                         VALUES (999999, toDateTime('{day(10)} 12:00:00'), 'view', 'ads')''')
+    try:
+        reports.populate_rollups()
+        assert clickhouse.query(week_pairs, 'DataFrame')['pairs'].iloc[0] == 1
+    finally:
+        clickhouse.query('''ALTER TABLE simulator_20250620.feed_actions
+                            DELETE WHERE user_id = 999999
+                            SETTINGS mutations_sync = 2''')
+
+    # Исправленные сырые данные: пара пользователя за неделю пропадает
+    reports.populate_rollups(day(10), day(10))
+    assert clickhouse.query(week_pairs, 'DataFrame')['pairs'].iloc[0] == 0